@@ -58,3 +58,20 @@ html_theme_options = {
 # relative to this directory. They are copied after the builtin static files,
 # so a file named "default.css" will overwrite the builtin "default.css".
 html_static_path = ['_static']
+
+
+# -- Metric plots ------------------------------------------------------------
+
+def render_metric_plots(app):
+    """Render the plots for each set that have changed since the last build"""
+    import os
+    from scarlet_test.measure import render_plots
+    from scarlet_test.settings import plot_sets
+    for set_id in plot_sets:
+        path = os.path.join(app.srcdir, "plots", set_id)
+        rendered = render_plots(set_id, path, image_path="/plots/{}".format(set_id))
+        print("rendered {} plots for {}".format(len(rendered), set_id))
+
+
+def setup(app):
+    app.connect("builder-inited", render_metric_plots)
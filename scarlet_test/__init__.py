@@ -1,4 +1,12 @@
 from . import deblend
 from . import measure
 from . import core
-from . import settings
\ No newline at end of file
+from . import settings
+from . import store
+from . import scenes
+from . import synthetic
+from . import archive
+from . import distributed
+from . import telemetry
+from . import sampling
+from . import compare
@@ -0,0 +1,254 @@
+import json
+import mmap
+import os
+import struct
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+
+# The extension of a blend archive. The archive for the blends in
+# the directory `data/blends/<set_id>` is `data/blends/<set_id>.blends`.
+ARCHIVE_EXTENSION = ".blends"
+# The last bytes of every archive
+MAGIC = b"SCLTBLND"
+# Every array is aligned to this many bytes
+ALIGNMENT = 64
+# The footer is the length of the index followed by `MAGIC`
+_FOOTER = struct.Struct("<Q8s")
+
+
+class BlendArchive:
+    """A single file containing all of the blends in a set
+
+    The arrays for every blend are stored uncompressed, one after another,
+    followed by a JSON index with the byte offset, dtype and shape of each
+    array for each blend, and any metadata (for example values derived from
+    the arrays that are expensive to calculate) stored with each blend.
+    The whole archive is memory mapped when it is opened, so loading a blend
+    is a zero-copy view into the archive and the set only needs to be
+    opened once, no matter how many blends it contains.
+    """
+    def __init__(self, filename: str):
+        """Initialize the class
+
+        :param filename: The name of the archive.
+        """
+        self.filename = filename
+        with open(filename, "rb") as f:
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            index_size, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a blend archive".format(filename))
+            f.seek(-_FOOTER.size - index_size, os.SEEK_END)
+            self.index = json.loads(f.read(index_size).decode("utf-8"))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def blend_ids(self) -> List[str]:
+        """The IDs of the blends in the archive, in the order they were written"""
+        return self.index["blend_ids"]
+
+    def __contains__(self, blend_id: str) -> bool:
+        return str(blend_id) in self.index["blends"]
+
+    def keys(self, blend_id: str) -> List[str]:
+        """The names of the arrays stored for a blend
+
+        :param blend_id: The ID of the blend.
+        :return: The names of the arrays.
+        """
+        return list(self._get_blend(blend_id).keys())
+
+    def _get_blend(self, blend_id: str) -> Dict:
+        """The index entry for a blend"""
+        try:
+            return self.index["blends"][str(blend_id)]
+        except KeyError:
+            raise ValueError("Blend {} is not in {}".format(blend_id, self.filename))
+
+    def get_metadata(self, blend_id: str) -> Dict:
+        """The metadata stored with a blend
+
+        :param blend_id: The ID of the blend.
+        :return: Dictionary of metadata, which is empty if
+            no metadata was stored with the blend.
+        """
+        return self.index.get("metadata", {}).get(str(blend_id), {})
+
+    def get_shape(self, blend_id: str, key: str) -> Tuple[int, ...]:
+        """The shape of an array, without loading it
+
+        :param blend_id: The ID of the blend.
+        :param key: The name of the array.
+        :return: The shape of the array.
+        """
+        return tuple(self._get_blend(blend_id)[key]["shape"])
+
+    def get_array(self, blend_id: str, key: str) -> np.ndarray:
+        """Load a single array
+
+        :param blend_id: The ID of the blend.
+        :param key: The name of the array.
+        :return: Read-only view of the array in the memory mapped archive.
+        """
+        entry = self._get_blend(blend_id)[key]
+        dtype = np.lib.format.descr_to_dtype(_to_descr(entry["dtype"]))
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        data = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=entry["offset"])
+        return data.reshape(entry["shape"])
+
+    def load(self, blend_id: str, keys: Sequence[str] = None) -> Dict[str, np.ndarray]:
+        """Load the arrays for a blend
+
+        :param blend_id: The ID of the blend.
+        :param keys: The names of the arrays to load.
+            If `keys` is `None` then all of the arrays are loaded.
+        :return: Dictionary of read-only views of the arrays for the blend.
+        """
+        if keys is None:
+            keys = self.keys(blend_id)
+        return {key: self.get_array(blend_id, key) for key in keys}
+
+    def close(self) -> None:
+        """Close the memory map of the archive
+
+        The archive cannot be closed while any of the arrays loaded from it are still in use.
+        """
+        self._mmap.close()
+
+
+def _to_descr(descr):
+    """Convert a dtype description loaded from JSON back into a numpy description
+
+    JSON turns the tuples of a structured dtype description into
+    lists, which `descr_to_dtype` does not accept.
+    """
+    if isinstance(descr, str):
+        return descr
+    return [tuple(_to_descr(item) if isinstance(item, list) else item for item in field) for field in descr]
+
+
+def write_archive(
+        filename: str,
+        blends: Iterable[Tuple[str, Dict[str, np.ndarray]]],
+        metadata: Callable[[Dict[str, np.ndarray]], Dict] = None,
+) -> List[str]:
+    """Write a blend archive
+
+    The archive is written to a temporary file that replaces
+    `filename` once it is complete, so a partially written
+    archive is never read.
+
+    :param filename: The name of the archive.
+    :param blends: Iterable of (blend ID, dictionary of arrays) for each blend.
+    :param metadata: Function that takes the arrays of a blend and returns a
+        JSON serializable dictionary of metadata stored with the blend
+        (see `BlendArchive.get_metadata`).
+    :return: The IDs of the blends in the archive.
+    """
+    index = {"blend_ids": [], "blends": {}, "metadata": {}}
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        for blend_id, data in blends:
+            blend_id = str(blend_id)
+            entry = {}
+            for key, array in data.items():
+                array = np.ascontiguousarray(array)
+                if array.dtype.hasobject:
+                    raise ValueError("Cannot archive the object array {} in blend {}".format(key, blend_id))
+                # Pad the file so that every array is aligned
+                f.write(b"\0" * (-f.tell() % ALIGNMENT))
+                entry[key] = {
+                    "offset": f.tell(),
+                    "dtype": np.lib.format.dtype_to_descr(array.dtype),
+                    "shape": list(array.shape),
+                }
+                f.write(array.tobytes())
+            index["blend_ids"].append(blend_id)
+            index["blends"][blend_id] = entry
+            if metadata is not None:
+                index["metadata"][blend_id] = metadata(data)
+        raw_index = json.dumps(index).encode("utf-8")
+        f.write(raw_index)
+        f.write(_FOOTER.pack(len(raw_index), MAGIC))
+    os.replace(tmp_filename, filename)
+    return index["blend_ids"]
+
+
+def convert_blends(
+        path: str,
+        filename: str = None,
+        blend_ids: Sequence[str] = None,
+        metadata: Callable[[Dict[str, np.ndarray]], Dict] = None,
+) -> str:
+    """Pack a directory of npz blend files into a single archive
+
+    :param path: The directory containing a "<blend ID>.npz" file for each blend.
+    :param filename: The name of the archive. If `filename` is `None` then
+        `get_archive_filename(path)` is used.
+    :param blend_ids: The IDs of the blends to pack, in order. If `blend_ids`
+        is `None` then all of the npz files in `path` are packed.
+    :param metadata: Function used to create the metadata stored with each blend
+        (see `write_archive`).
+    :return: The name of the archive.
+    """
+    if filename is None:
+        filename = get_archive_filename(path)
+    if blend_ids is None:
+        blend_ids = sorted(f.split(".")[0] for f in os.listdir(path) if f.endswith(".npz"))
+
+    def blends():
+        for blend_id in blend_ids:
+            with np.load(os.path.join(path, "{}.npz".format(blend_id))) as data:
+                yield blend_id, {key: data[key] for key in data.keys()}
+
+    write_archive(filename, blends(), metadata)
+    return filename
+
+
+def get_archive_filename(path: str) -> str:
+    """The name of the archive for a directory of blends
+
+    :param path: The directory of npz blend files.
+    :return: The name of the archive.
+    """
+    return os.path.normpath(path) + ARCHIVE_EXTENSION
+
+
+_archives = {}
+
+
+def get_archive(filename: str) -> BlendArchive:
+    """Open a blend archive
+
+    Each archive is only opened once per process,
+    unless it has been rewritten since it was opened.
+
+    :param filename: The name of the archive.
+    :return: The archive.
+    """
+    mtime = os.path.getmtime(filename)
+    if filename in _archives:
+        archive, archive_mtime = _archives[filename]
+        if archive_mtime == mtime:
+            return archive
+    archive = BlendArchive(filename)
+    _archives[filename] = (archive, mtime)
+    return archive
+
+
+def split_blend_filename(filename: str) -> Tuple[str, str]:
+    """Check whether or not a blend filename points into an archive
+
+    Blends in an archive are named as if the archive was the directory
+    containing the blends, for example `data/blends/set1.blends/<blend ID>.npz`.
+
+    :param filename: The name of the blend file.
+    :return: The name of the archive and the blend ID, or `None`
+        if the blend is not in an archive.
+    """
+    archive_filename, basename = os.path.split(filename)
+    if archive_filename.endswith(ARCHIVE_EXTENSION) and os.path.isfile(archive_filename):
+        return archive_filename, basename.split(".")[0]
+    return None
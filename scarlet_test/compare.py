@@ -0,0 +1,364 @@
+import math
+from collections.abc import Mapping
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from .core import get_store
+from .measure import all_metrics
+from .sampling import get_row_blend_ids, weighted_median
+from .store import MeasurementStore
+
+
+# Metrics where an increase is a regression, used to gate merges
+cost_metrics = (
+    "init time", "runtime", "iterations", "peak memory (MB)", "peak RSS (MB)",
+    "init time median", "runtime median",
+)
+
+
+def get_row_keys(blend_ids: np.ndarray) -> np.ndarray:
+    """Give each row a key that is unique for the blend and source
+
+    :param blend_ids: The blend ID of each row. The rows for each blend
+        are always stored together, in the order of the sources in the blend.
+    :return: A "<blend ID>/<index of the source in the blend>" key for each row.
+    """
+    blend_ids = np.asarray(blend_ids).astype(str)
+    _, first, inverse = np.unique(blend_ids, return_index=True, return_inverse=True)
+    source_index = np.arange(len(blend_ids)) - first[inverse]
+    return np.char.add(np.char.add(blend_ids, "/"), source_index.astype(str))
+
+
+def pair_records(
+        store: MeasurementStore,
+        base_branch: str,
+        new_branch: str,
+        names: Sequence[str],
+        base_ids: np.ndarray = None,
+        new_ids: np.ndarray = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Pair the measurements for the same sources in two branches
+
+    :param store: The measurement store containing both branches.
+    :param base_branch: The branch to compare against.
+    :param new_branch: The branch being tested.
+    :param names: The names of the metrics to pair.
+    :param base_ids: The blend ID of each row in `base_branch`.
+        If `base_ids` is `None` then the blend IDs in the store are used.
+    :param new_ids: The blend ID of each row in `new_branch`.
+        If `new_ids` is `None` then the blend IDs in the store are used.
+    :return: Two arrays with shape (metrics, sources), the first for
+        `base_branch` and the second for `new_branch`, and the blend ID of each
+        pair (or `None` if the branches do not have blend IDs).
+    """
+    if base_ids is None:
+        base_ids = store.get_blend_ids(base_branch)
+    if new_ids is None:
+        new_ids = store.get_blend_ids(new_branch)
+    if np.any(base_ids == "") or np.any(new_ids == ""):
+        # Branches migrated from the old npz files do not have blend IDs,
+        # so the rows can only be paired if they line up exactly
+        if len(base_ids) != len(new_ids):
+            msg = "Cannot pair {} and {} without blend IDs, they have a different number of sources"
+            raise ValueError(msg.format(base_branch, new_branch))
+        base_idx = new_idx = np.arange(len(base_ids))
+        blend_ids = None
+    else:
+        _, base_idx, new_idx = np.intersect1d(
+            get_row_keys(base_ids), get_row_keys(new_ids), return_indices=True)
+        blend_ids = np.asarray(base_ids).astype(str)[base_idx]
+    base = np.array([store.get_column(name, base_branch)[base_idx] for name in names], dtype=float)
+    new = np.array([store.get_column(name, new_branch)[new_idx] for name in names], dtype=float)
+    return base, new, blend_ids
+
+
+def get_blend_metrics(values: Sequence[np.ndarray], blends: np.ndarray) -> np.ndarray:
+    """Find the metrics that are measured once for each blend
+
+    Metrics like the runtime or the number of iterations are measured for the
+    whole blend and repeated for every source, so the sources in a blend
+    are not independent samples of these metrics.
+
+    :param values: Arrays with shape (metrics, sources), for example the
+        paired measurements from both branches.
+    :param blends: The index of the blend of each source.
+    :return: Whether or not each metric is the same for every source in each blend.
+    """
+    num_blends = np.max(blends) + 1 if len(blends) > 0 else 0
+    is_blend_metric = np.ones(len(values[0]), dtype=bool)
+    for data in values:
+        for m, column in enumerate(data):
+            # NaN is treated as a value, so that it has to be repeated as well
+            column = np.where(np.isnan(column), np.inf, column)
+            high = np.full(num_blends, -np.inf)
+            low = np.full(num_blends, np.inf)
+            np.maximum.at(high, blends, column)
+            np.minimum.at(low, blends, column)
+            is_blend_metric[m] &= np.all(high == low)
+    return is_blend_metric
+
+
+def rankdata(data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Rank each row of an array, giving tied values their average rank
+
+    :param data: 2D array to rank along its last axis.
+    :return: The ranks (starting at 1) of `data` and the tie correction
+        `sum(t**3 - t)` for each row, where `t` is the size of each group of ties.
+    """
+    rows, cols = data.shape
+    order = np.argsort(data, axis=1, kind="stable")
+    sorted_data = np.take_along_axis(data, order, axis=1)
+    # Label each group of tied values, with labels that are unique across rows
+    new_group = np.ones(data.shape, dtype=bool)
+    new_group[:, 1:] = sorted_data[:, 1:] != sorted_data[:, :-1]
+    groups = np.cumsum(new_group.ravel()) - 1
+    counts = np.bincount(groups)
+    positions = np.tile(np.arange(1, cols + 1), rows)
+    mean_rank = np.bincount(groups, weights=positions) / counts
+    ranks = np.empty(data.shape)
+    np.put_along_axis(ranks, order, mean_rank[groups].reshape(data.shape), axis=1)
+    group_rows = np.repeat(np.arange(rows), cols)[new_group.ravel()]
+    ties = np.bincount(group_rows, weights=counts**3 - counts, minlength=rows)
+    return ranks, ties
+
+
+def wilcoxon(base: np.ndarray, new: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Wilcoxon signed-rank test for each row of paired measurements
+
+    The normal approximation is used, which is accurate for the
+    number of sources in each test set.
+
+    :param base: The base measurements, with shape (metrics, sources).
+    :param new: The new measurements, with shape (metrics, sources).
+    :return: The z-score and two-sided p-value for each metric.
+        Pairs with no difference are ignored.
+    """
+    diff = new - base
+    nonzero = diff != 0
+    # Zero differences are ranked last and then ignored
+    ranks, ties = rankdata(np.where(nonzero, np.abs(diff), np.inf))
+    n = np.sum(nonzero, axis=1)
+    # Remove the tied zero differences from the tie correction
+    zeros = diff.shape[1] - n
+    ties = ties - (zeros**3 - zeros)
+    w_plus = np.sum(np.where(nonzero & (diff > 0), ranks, 0), axis=1)
+    mean = n * (n + 1) / 4
+    var = n * (n + 1) * (2 * n + 1) / 24 - ties / 48
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.where(var > 0, (w_plus - mean) / np.sqrt(var), 0)
+    p = np.array([math.erfc(abs(_z) / math.sqrt(2)) for _z in z])
+    return z, p
+
+
+def bootstrap_ratio(
+        base: np.ndarray,
+        new: np.ndarray,
+        samples: int = 1000,
+        confidence: float = 0.95,
+        seed: int = None,
+        blends: np.ndarray = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Bootstrap confidence interval of the ratio of the medians
+
+    The same resampled pairs are used for every metric,
+    so all of the metrics are resampled at once.
+
+    :param base: The base measurements, with shape (metrics, sources).
+    :param new: The new measurements, with shape (metrics, sources).
+    :param samples: The number of bootstrap samples.
+    :param confidence: The confidence level of the interval.
+    :param seed: The seed of the random number generator.
+    :param blends: The index of the blend of each source. The sources in a blend
+        are not independent, so the blends are resampled (with all of their sources).
+        If `blends` is `None` then each source is resampled independently.
+    :return: The lower and upper bounds of `median(new)/median(base)` for each metric.
+    """
+    rng = np.random.default_rng(seed)
+    if blends is None:
+        blends = np.arange(base.shape[1])
+    num_blends = np.max(blends) + 1
+    idx = rng.integers(0, num_blends, size=(samples, num_blends))
+    # The number of times each source is included in each sample
+    counts = np.zeros((samples, num_blends), dtype=np.int32)
+    np.add.at(counts, (np.arange(samples)[:, None], idx), 1)
+    weights = counts[:, blends]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = weighted_median(new, weights) / weighted_median(base, weights)
+    alpha = (1 - confidence) / 2
+    low, high = np.percentile(ratios, [100 * alpha, 100 * (1 - alpha)], axis=1)
+    return low, high
+
+
+def compare(
+        set_id: str,
+        base_branch: str,
+        new_branch: str,
+        metrics: Sequence[str] = None,
+        samples: int = 1000,
+        confidence: float = 0.95,
+        seed: int = None,
+) -> np.rec.recarray:
+    """Compare the measurements of two branches
+
+    :param set_id: ID of the set to compare.
+    :param base_branch: The branch to compare against.
+    :param new_branch: The branch being tested.
+    :param metrics: The names of the metrics to compare. If `metrics` is `None`
+        then all of the metrics in `all_metrics` measured in both branches are used.
+    :param samples: The number of bootstrap samples.
+    :param confidence: The confidence level of the bootstrap interval.
+    :param seed: The seed used for the bootstrap.
+    :return: Records with the paired statistics for each metric:
+
+        * `metric`: The name of the metric.
+        * `pairs`: The number of paired sources. Metrics that are measured once for
+          each blend (see `get_blend_metrics`) are compared with a single value for
+          each blend, so for these metrics this is the number of paired blends.
+        * `base median`, `new median`: The median of each branch.
+        * `median ratio`: `new median / base median`.
+        * `ratio low`, `ratio high`: Bootstrap confidence interval of `median ratio`.
+        * `median diff`: The median of the paired differences (new - base).
+        * `z`, `p`: The Wilcoxon signed-rank z-score and p-value.
+
+        The sources in a blend are not independent, so the
+        bootstrap resamples blends rather than sources.
+
+        If either branch has been compacted then the sources cannot be paired,
+        so only the medians (from the branch summaries) are compared and
+        `pairs` is zero, while the bootstrap interval and test statistics are `NaN`.
+    """
+    store = get_store(set_id)
+    for branch in [base_branch, new_branch]:
+        if branch not in store.branches and branch not in store.compacted_branches:
+            raise ValueError("Branch {} has not been analyzed for set {}".format(branch, set_id))
+    if metrics is None:
+        metrics = list(all_metrics.keys())
+    base_records = store.get_branch(base_branch)
+    new_records = store.get_branch(new_branch)
+    names = [name for name in metrics if name in base_records and name in new_records]
+    if len(names) == 0:
+        raise ValueError("{} and {} do not have any metrics in common".format(base_branch, new_branch))
+    if getattr(base_records, "compacted", False) or getattr(new_records, "compacted", False):
+        return compare_summaries(base_records, new_records, names)
+
+    base, new, blend_ids = pair_records(
+        store, base_branch, new_branch, names,
+        get_row_blend_ids(store, base_branch, set_id), get_row_blend_ids(store, new_branch, set_id))
+    if base.shape[1] == 0:
+        raise ValueError("{} and {} do not have any sources in common".format(base_branch, new_branch))
+    if blend_ids is None:
+        print("warning: the blend IDs of {} and {} are unknown, so every source is treated as independent".format(
+            base_branch, new_branch))
+        blends = np.arange(base.shape[1])
+    else:
+        _, first, blends = np.unique(blend_ids, return_index=True, return_inverse=True)
+    is_blend_metric = get_blend_metrics([base, new], blends)
+
+    pairs = np.zeros(len(names), dtype=int)
+    base_median, new_median, low, high, median_diff, z, p = np.full((7, len(names)), np.nan)
+    for selected in [~is_blend_metric, is_blend_metric]:
+        if not np.any(selected):
+            continue
+        _base, _new, _blends = base[selected], new[selected], blends
+        if selected is is_blend_metric and blend_ids is not None:
+            # Use a single value for each blend
+            _base, _new, _blends = _base[:, first], _new[:, first], None
+        pairs[selected] = _base.shape[1]
+        base_median[selected] = np.median(_base, axis=1)
+        new_median[selected] = np.median(_new, axis=1)
+        median_diff[selected] = np.median(_new - _base, axis=1)
+        low[selected], high[selected] = bootstrap_ratio(_base, _new, samples, confidence, seed, _blends)
+        z[selected], p[selected] = wilcoxon(_base, _new)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = new_median / base_median
+
+    return np.rec.fromarrays([
+        names,
+        pairs,
+        base_median,
+        new_median,
+        ratio,
+        low,
+        high,
+        median_diff,
+        z,
+        p,
+    ], names=[
+        "metric", "pairs", "base median", "new median", "median ratio",
+        "ratio low", "ratio high", "median diff", "z", "p",
+    ])
+
+
+def compare_summaries(base_records: Mapping, new_records: Mapping, names: Sequence[str]) -> np.rec.recarray:
+    """Compare the medians of two branches when at least one has been compacted
+
+    :param base_records: The records (or summary) of the base branch.
+    :param new_records: The records (or summary) of the new branch.
+    :param names: The names of the metrics to compare.
+    :return: The same records as `compare`, with `NaN` for the
+        statistics that need the measurements for each source.
+    """
+    base_median = np.array([np.nanmedian(base_records[name]) for name in names])
+    new_median = np.array([np.nanmedian(new_records[name]) for name in names])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = new_median / base_median
+    nan = np.full(len(names), np.nan)
+    return np.rec.fromarrays([
+        names, np.zeros(len(names), dtype=int), base_median, new_median, ratio,
+        nan, nan, new_median - base_median, nan, nan,
+    ], names=[
+        "metric", "pairs", "base median", "new median", "median ratio",
+        "ratio low", "ratio high", "median diff", "z", "p",
+    ])
+
+
+def get_regressions(
+        comparison: np.rec.recarray,
+        threshold: float = 0.05,
+        alpha: float = 0.01,
+        metrics: Sequence[str] = cost_metrics,
+) -> List[str]:
+    """Find the metrics that have regressed
+
+    :param comparison: The result of `compare`.
+    :param threshold: The fractional increase in the median that counts
+        as a regression (for example 0.05 is a 5% increase).
+    :param alpha: The significance level of the Wilcoxon test.
+    :param metrics: The metrics where an increase is a regression.
+    :return: The names of the metrics that increased by more than `threshold`,
+        where the change is statistically significant. If the change could not be
+        tested (`p` is `NaN`, for example when either branch has been compacted)
+        then the metric is a regression if it increased by more than `threshold`,
+        so that the gate never passes just because the test could not be run.
+    """
+    untested = np.isnan(comparison["p"])
+    regressed = (
+        np.isin(comparison["metric"], metrics)
+        & (comparison["median ratio"] > 1 + threshold)
+        & ((comparison["p"] < alpha) | untested)
+    )
+    return comparison["metric"][regressed].tolist()
+
+
+def format_comparison(comparison: np.rec.recarray, regressions: Sequence[str] = ()) -> str:
+    """Format the result of `compare` as a table
+
+    :param comparison: The result of `compare`.
+    :param regressions: The metrics to flag as regressions.
+        Regressions that could not be tested for significance are flagged as "(untested)".
+    :return: The formatted table.
+    """
+    header = "{:<20} {:>12} {:>12} {:>8} {:>18} {:>10}".format(
+        "metric", "base median", "new median", "ratio", "ratio interval", "p")
+    lines = [header, "-" * len(header)]
+    for row in comparison:
+        line = "{:<20} {:>12.4g} {:>12.4g} {:>8.3f} {:>18} {:>10.2e}".format(
+            row["metric"], row["base median"], row["new median"], row["median ratio"],
+            "[{:.3f}, {:.3f}]".format(row["ratio low"], row["ratio high"]), row["p"])
+        if row["metric"] in regressions:
+            line += "  REGRESSION"
+            if np.isnan(row["p"]):
+                line += " (untested)"
+        lines.append(line)
+    return "\n".join(lines)
@@ -1,15 +1,29 @@
 import json
 import os
 import errno
-from typing import List, Callable
+import hashlib
+import queue
+import signal
+import threading
+import time
+import traceback
+import zipfile
 import shutil
+from contextlib import contextmanager
+from typing import List, Callable, Dict, Sequence, Iterator, Tuple
 from functools import partial
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, as_completed
 
 import numpy as np
 import matplotlib.pyplot as plt
 
 from . import deblend
 from . import settings
+from .instrument import MEMORY_LOCK
+from .store import ROWS_PER_BLEND, MeasurementStore, RecordBuilder
+from .scenes import SceneWriter, get_scene, plot_scene
+from .archive import ARCHIVE_EXTENSION, convert_blends, get_archive, get_archive_filename, split_blend_filename
+from .telemetry import ProgressMonitor, get_blend_stats, get_event_stream
 
 
 # Paths to directories for different file types
@@ -27,18 +41,57 @@ def get_blend_ids(path: str=None, set_id: str=None) -> List[str]:
 
     Either `path` or `set_id` must be given.
 
-    :param path: Path to blends
+    :param path: Path to blends. If the blends have been packed into an archive
+        (see `pack_blends`) then the blend IDs are read from the archive.
     :param set_id: Set containing blend ids
     :return: List of blend IDs
     """
     if path:
-        blend_ids = [f.split(".")[0] for f in os.listdir(path)]
+        archive_filename = get_blend_path(path)
+        if archive_filename != path or path.endswith(ARCHIVE_EXTENSION):
+            # The archive index contains the blend IDs, so there is no need to scan the directory
+            blend_ids = get_archive(archive_filename).blend_ids
+        else:
+            blend_ids = [f.split(".")[0] for f in os.listdir(path)]
     else:
         id_data = np.load(os.path.join(__BLEND_PATH__, "test_ids.npz"))
         blend_ids = id_data[set_id]
     return blend_ids
 
 
+def get_blend_path(path: str) -> str:
+    """The location of the blends in a set
+
+    :param path: The directory of npz blend files.
+    :return: The archive of the blends in `path` if it exists (see `pack_blends`),
+        otherwise `path`.
+    """
+    archive_filename = get_archive_filename(path)
+    if os.path.isfile(archive_filename):
+        return archive_filename
+    return path
+
+
+def pack_blends(set_id: str = None, path: str = None) -> str:
+    """Pack the npz files for each blend in a set into a single archive
+
+    Once the archive exists the blends are loaded from the archive
+    instead of the npz files. The log likelihood normalization of each
+    blend is stored in the archive (see `deblend.get_blend_metadata`),
+    so it never has to be calculated when deblending.
+
+    :param set_id: ID of the set to pack.
+    :param path: The directory of npz blend files. If `path` is `None`
+        then the blends for `set_id` are packed.
+    :return: The name of the archive.
+    """
+    if path is None:
+        path = os.path.join(__BLEND_PATH__, set_id)
+    filename = convert_blends(path, metadata=deblend.get_blend_metadata)
+    print("packed the blends in {} into {}".format(path, filename))
+    return filename
+
+
 def get_branches() -> List[str]:
     """Load all of the branches that have been processed
 
@@ -101,6 +154,697 @@ def get_filename(pr: str) -> str:
     return "{}.npz".format(pr)
 
 
+def get_store_path(set_id: str) -> str:
+    """The directory containing the measurement store for a set
+
+    :param set_id: ID of the set
+    :return: The path to the measurement store
+    """
+    return os.path.join(__DATA_PATH__, set_id, "records")
+
+
+def get_store(set_id: str) -> MeasurementStore:
+    """Load the columnar measurement store for a set
+
+    :param set_id: ID of the set
+    :return: The store containing the records of every branch in the set
+    """
+    return MeasurementStore(get_store_path(set_id))
+
+
+def migrate_records(set_id: str) -> MeasurementStore:
+    """Copy the records from the per branch npz files into the measurement store
+
+    Only branches that are not already in the store are migrated.
+
+    :param set_id: ID of the set to migrate
+    :return: The measurement store for the set
+    """
+    store = get_store(set_id)
+    records = {}
+    for branch in get_branches():
+        filename = os.path.join(__DATA_PATH__, set_id, get_filename(branch))
+        migrated = branch in store.branches or branch in store.compacted_branches
+        if not migrated and os.path.exists(filename):
+            records[branch] = np.load(filename)["records"]
+    if len(records) > 0:
+        print("migrating {} branches to {}".format(len(records), store.path))
+        store.add_branches(records)
+    return store
+
+
+def compact_records(set_id: str, keep: int = 20) -> MeasurementStore:
+    """Compact the records of all but the most recent branches
+
+    The records for the `keep` most recent branches (in the order of
+    `branches.json`) are kept in full, while the older branches are replaced
+    by their summary statistics (see `MeasurementStore.compact`). The old npz
+    records, cached measurements and saved models of the compacted branches
+    are also removed, so the disk space used by a set does not grow with
+    the number of branches.
+
+    :param set_id: ID of the set to compact.
+    :param keep: The number of branches to keep in full. At least two
+        branches are always kept, since the scatter plots (and `compare`)
+        need the records for each source.
+    :return: The measurement store for the set.
+    """
+    if keep < 2:
+        raise ValueError("At least two branches must be kept in full, got keep={}".format(keep))
+    store = get_store(set_id)
+    branches = [branch for branch in get_branches() if branch in store.branches]
+    # Branches that are not in `branches.json` are the oldest
+    branches = [branch for branch in store.branches if branch not in branches] + branches
+    compacted = branches[:-keep]
+    if len(compacted) == 0:
+        return store
+    print("compacting {} branches in {}".format(len(compacted), store.path))
+    store.compact(compacted)
+    for branch in compacted:
+        filename = os.path.join(__DATA_PATH__, set_id, get_filename(branch))
+        if os.path.exists(filename):
+            os.remove(filename)
+        cache_path = get_cache_path(set_id, branch)
+        if os.path.isdir(cache_path):
+            shutil.rmtree(cache_path)
+    return store
+
+
+def get_cache_path(set_id: str, branch: str) -> str:
+    """The directory used to cache the measurements for each blend
+
+    :param set_id: ID of the set being analyzed
+    :param branch: The scarlet branch being analyzed
+    :return: The path to the cached blends. The caches are kept in their own
+        directory, so that a branch can have any name (even "records")
+        without overwriting the measurement store.
+    """
+    return os.path.join(__DATA_PATH__, set_id, "cache", branch)
+
+
+def describe_deblender(deblender: Callable) -> str:
+    """Describe a deblender in a way that is consistent between runs
+
+    :param deblender: The function used to deblend.
+    :return: A string with the qualified name of the deblender and any
+        arguments bound to it with `partial`.
+    """
+    if isinstance(deblender, partial):
+        keywords = sorted(deblender.keywords.items())
+        return "{}({}, {})".format(describe_deblender(deblender.func), deblender.args, keywords)
+    name = getattr(deblender, "__qualname__", type(deblender).__qualname__)
+    return "{}.{}".format(getattr(deblender, "__module__", None), name)
+
+
+def get_blend_keys(deblender: Callable) -> Sequence[str]:
+    """The arrays that a deblender needs from each blend file
+
+    :param deblender: The function used to deblend.
+    :return: `deblend.BLEND_KEYS` if `deblender` is `deblend.deblend`
+        (or a `partial` of it), otherwise `None` so that all of the arrays are loaded.
+    """
+    while isinstance(deblender, partial):
+        deblender = deblender.func
+    if deblender is deblend.deblend:
+        return deblend.BLEND_KEYS
+    return None
+
+
+def get_record_dtype(deblender: Callable, warm_start: bool = False) -> np.dtype:
+    """The dtype of the measurements returned by a deblender
+
+    :param deblender: The function used to deblend.
+    :param warm_start: Whether or not the sources are warm started.
+    :return: The dtype of the records, or `None` if the deblender
+        does not declare its output. A deblender can declare its output
+        with a `record_dtype` attribute.
+    """
+    keywords = {}
+    func = deblender
+    while isinstance(func, partial):
+        keywords = dict(func.keywords, **keywords)
+        func = func.func
+    if func is deblend.deblend:
+        return deblend.get_record_dtype(
+            settings.filters,
+            keywords.get("trace_memory", False),
+            warm_start,
+            keywords.get("trials", 0) > 0,
+        )
+    return getattr(deblender, "record_dtype", getattr(func, "record_dtype", None))
+
+
+def get_config_hash(deblender: Callable, warm_start: str = None, include_version: bool = True) -> str:
+    """Hash the configuration used to deblend a blend
+
+    Cached blend measurements are only reused if they were
+    created with the same configuration.
+
+    :param deblender: The function used to deblend.
+    :param warm_start: The branch used to warm start the sources, if any.
+    :param include_version: Whether or not the installed scarlet version is part
+        of the configuration. The distributed queue leaves it out, since the
+        coordinator does not have the branch of each worker installed.
+    :return: A short hex digest of the configuration.
+    """
+    version = None
+    if include_version:
+        try:
+            import scarlet
+            version = getattr(scarlet, "__version__", None)
+        except ImportError:
+            pass
+    config = {
+        "max_iter": settings.max_iter,
+        "e_rel": settings.e_rel,
+        "deblender": describe_deblender(deblender),
+        "scarlet": version,
+        "warm_start": warm_start,
+    }
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def get_cache_filename(cache_path: str, blend_id: str, config_hash: str) -> str:
+    """Consistently set the filename for each cached blend
+
+    :param cache_path: The directory containing the cached blends.
+    :param blend_id: The ID of the blend.
+    :param config_hash: The hash of the deblender configuration.
+    :return: The filename of the cached measurements for the blend.
+    """
+    return os.path.join(cache_path, "{}.{}.npz".format(blend_id, config_hash))
+
+
+def load_cached_blend(cache_path: str, blend_id: str, config_hash: str) -> np.ndarray:
+    """Load the cached measurements for a blend
+
+    :param cache_path: The directory containing the cached blends.
+    :param blend_id: The ID of the blend.
+    :param config_hash: The hash of the deblender configuration.
+    :return: Structured array with the measurements for the blend, or `None`
+        if the blend has not been cached with the current configuration.
+    """
+    filename = get_cache_filename(cache_path, blend_id, config_hash)
+    if not os.path.exists(filename):
+        return None
+    return np.load(filename)["records"]
+
+
+def cache_blend(
+        cache_path: str,
+        blend_id: str,
+        config_hash: str,
+        measurements,
+) -> None:
+    """Cache the measurements for a single blend
+
+    :param cache_path: The directory containing the cached blends.
+    :param blend_id: The ID of the blend.
+    :param config_hash: The hash of the deblender configuration.
+    :param measurements: Either a structured array or a list of dictionaries
+        with the measurements for the blend.
+    """
+    if isinstance(measurements, np.ndarray):
+        records = measurements
+    elif len(measurements) > 0:
+        keys = tuple(measurements[0].keys())
+        records = np.rec.fromrecords([tuple(m[key] for key in keys) for m in measurements], names=keys)
+    else:
+        records = np.array([])
+    # Write to a temporary file first so that an interrupted run
+    # never leaves a partially written blend in the cache
+    filename = get_cache_filename(cache_path, blend_id, config_hash)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        np.savez(f, records=records)
+    os.replace(tmp_filename, filename)
+
+
+def clear_stale_cache(cache_path: str, config_hash: str) -> None:
+    """Remove all of the cached blends made with a different configuration
+
+    :param cache_path: The directory containing the cached blends.
+    :param config_hash: The hash of the current deblender configuration.
+    """
+    if not os.path.exists(cache_path):
+        return
+    for f in os.listdir(cache_path):
+        if f.endswith(".npz") and f.split(".")[-2] != config_hash:
+            os.remove(os.path.join(cache_path, f))
+
+
+class BlendData(dict):
+    """Dictionary of the arrays for a single blend
+
+    This behaves exactly like a `dict`, but also keeps track of the
+    file that the blend was loaded from.
+    """
+    def __init__(self, filename: str, *args, **kwargs):
+        """Initialize the class
+
+        :param filename: The name of the npz file containing the blend data.
+        """
+        super().__init__(*args, **kwargs)
+        self.filename = filename
+        # Metadata stored with the blend in an archive (see `archive.BlendArchive.get_metadata`)
+        self.metadata = {}
+
+    @property
+    def blend_id(self) -> str:
+        """The ID of the blend"""
+        return os.path.basename(self.filename).split(".")[0]
+
+
+def load_blend(filename: str, keys: Sequence[str] = None) -> BlendData:
+    """Load the data for a single blend
+
+    :param filename: The name of the npz file containing the blend data.
+        If the blend is in an archive then this is "<archive>/<blend ID>.npz"
+        (see `archive.split_blend_filename`) and the arrays are read-only
+        views of the memory mapped archive.
+    :param keys: The keys to load from the npz file.
+        If `keys` is `None` then all of the arrays in the file are loaded.
+    :return: Dictionary of the arrays for the blend.
+    """
+    location = split_blend_filename(filename)
+    if location is not None:
+        archive_filename, blend_id = location
+        archive = get_archive(archive_filename)
+        data = BlendData(filename, archive.load(blend_id, keys))
+        data.metadata = archive.get_metadata(blend_id)
+        return data
+    with np.load(filename) as data:
+        if keys is None:
+            keys = data.keys()
+        return BlendData(filename, {key: data[key] for key in keys})
+
+
+def iter_blends(
+        filenames: Sequence[str],
+        keys: Sequence[str] = None,
+        prefetch: int = 2,
+        return_errors: bool = False,
+) -> Iterator[Dict]:
+    """Iterate over the data for a collection of blends
+
+    The blends are read and decompressed in a background thread, so that
+    loading the next `prefetch` blends overlaps with deblending the
+    current blend, while never holding more than `prefetch` blends in memory.
+    Loading is paused while the memory of a blend is measured
+    (see `instrument.Instrument.memory`), so the peak RSS is the same with or without prefetching.
+
+    :param filenames: The npz file for each blend.
+    :param keys: The keys to load from each npz file (see `load_blend`).
+    :param prefetch: The maximum number of blends to load ahead of time.
+        If `prefetch` is `0` then each blend is loaded when it is needed.
+    :param return_errors: Whether or not to yield a tuple (`data`, `error`)
+        for each blend, where `error` is the exception raised while loading the
+        blend (and `data` is `None`), so that the remaining blends are still loaded.
+        Otherwise the first error is raised.
+    :return: Generator that yields the data for each blend,
+        in the same order as `filenames`.
+    """
+    if prefetch < 1:
+        for filename in filenames:
+            try:
+                item = (load_blend(filename, keys), None)
+            except Exception as e:
+                if not return_errors:
+                    raise
+                item = (None, e)
+            yield item if return_errors else item[0]
+        return
+
+    blends = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def load():
+        for filename in filenames:
+            try:
+                # Wait while the memory of a blend is measured, so that loading does not count towards it
+                with MEMORY_LOCK:
+                    item = (load_blend(filename, keys), None)
+            except Exception as e:
+                item = (None, e)
+            # Check periodically whether or not the consumer has stopped
+            while not stop.is_set():
+                try:
+                    blends.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set() or (item[1] is not None and not return_errors):
+                return
+
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    try:
+        for _ in filenames:
+            data, error = blends.get()
+            if error is not None and not return_errors:
+                raise error
+            yield (data, error) if return_errors else data
+    finally:
+        stop.set()
+        thread.join()
+
+
+def get_model_path(set_id: str, branch: str) -> str:
+    """The directory used to store the converged models for a branch
+
+    :param set_id: ID of the set
+    :param branch: The scarlet branch
+    :return: The path to the models for each blend
+    """
+    return os.path.join(get_cache_path(set_id, branch), "models")
+
+
+def save_models(model_path: str, blend_id: str, parameters: List[List[np.ndarray]]) -> None:
+    """Save the converged parameters for each source in a blend
+
+    :param model_path: The directory containing the models.
+    :param blend_id: The ID of the blend.
+    :param parameters: The parameters of each source (see `deblend.get_parameters`).
+    """
+    arrays = {"num_sources": len(parameters)}
+    for k, params in enumerate(parameters):
+        if params is not None:
+            for p, param in enumerate(params):
+                arrays["{}_{}".format(k, p)] = param
+    os.makedirs(model_path, exist_ok=True)
+    np.savez(os.path.join(model_path, "{}.npz".format(blend_id)), **arrays)
+
+
+def load_models(model_path: str, blend_id: str) -> List[List[np.ndarray]]:
+    """Load the converged parameters for each source in a blend
+
+    :param model_path: The directory containing the models.
+    :param blend_id: The ID of the blend.
+    :return: The parameters of each source (see `deblend.get_parameters`),
+        or `None` if the blend has not been saved.
+    """
+    filename = os.path.join(model_path, "{}.npz".format(blend_id))
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as data:
+        parameters = [[] for _ in range(int(data["num_sources"]))]
+        keys = sorted([key for key in data.keys() if key != "num_sources"],
+                      key=lambda key: tuple(int(k) for k in key.split("_")))
+        for key in keys:
+            parameters[int(key.split("_")[0])].append(data[key])
+    return [params if len(params) > 0 else None for params in parameters]
+
+
+class BlendTimeout(Exception):
+    """Raised when deblending a blend takes longer than its time limit"""
+    pass
+
+
+@contextmanager
+def time_limit(seconds: float):
+    """Raise a `BlendTimeout` if the code takes longer than `seconds`
+
+    The time limit uses `SIGALRM`, so it is only enforced in the main thread
+    of a process (which includes the workers in a `ProcessPoolExecutor`)
+    on platforms that support `signal.setitimer`.
+
+    :param seconds: The maximum wall clock time. If `seconds` is `None`
+        then there is no time limit.
+    """
+    if (seconds is None or not hasattr(signal, "setitimer")
+            or threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise BlendTimeout("Exceeded the time limit of {} seconds".format(seconds))
+
+    old_handler = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def read_array_shape(filename: str, key: str) -> Tuple[int, ...]:
+    """Read the shape of an array in an npz file without loading the array
+
+    :param filename: The name of the npz file (see `load_blend`).
+    :param key: The name of the array.
+    :return: The shape of the array.
+    """
+    location = split_blend_filename(filename)
+    if location is not None:
+        archive_filename, blend_id = location
+        return get_archive(archive_filename).get_shape(blend_id, key)
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open("{}.npy".format(key)) as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return shape
+
+
+def estimate_costs(filenames: Sequence[str], history: Dict[str, float] = None) -> np.ndarray:
+    """Estimate the relative cost of deblending each blend
+
+    :param filenames: The npz file for each blend.
+    :param history: Dictionary (blend ID, time) of the time it took to
+        deblend each blend in a previous run (see `get_blend_history`). If all
+        of the blends are in `history` then those times are used as the cost.
+    :return: The cost of each blend. If the cost cannot be taken from
+        `history` then the number of pixels in the images times the number
+        of sources is used. Blends that cannot be read are given the median
+        cost of the other blends (they fail when they are deblended).
+    """
+    blend_ids = [os.path.basename(filename).split(".")[0] for filename in filenames]
+    if history is not None and all(blend_id in history for blend_id in blend_ids):
+        return np.array([history[blend_id] for blend_id in blend_ids])
+    costs = []
+    for filename in filenames:
+        try:
+            shape = read_array_shape(filename, "images")
+            sources = read_array_shape(filename, "centers")[0]
+        except Exception:
+            costs.append(np.nan)
+            continue
+        costs.append(np.prod(shape) * sources)
+    costs = np.array(costs, dtype=float)
+    unreadable = np.isnan(costs)
+    if np.any(unreadable):
+        costs[unreadable] = np.median(costs[~unreadable]) if np.any(~unreadable) else 0
+    return costs
+
+
+def get_blend_history(set_id: str) -> Dict[str, float]:
+    """The time it took to deblend each blend in the latest branch
+
+    :param set_id: ID of the set
+    :return: Dictionary (blend ID, time in ms) for the latest branch in the
+        measurement store that has blend IDs and the `runtime` and `init time`
+        metrics, or `None` if no branch has been stored with that information.
+    """
+    store = get_store(set_id)
+    for branch in store.branches[::-1]:
+        if not (store.has_column("runtime", branch) and store.has_column("init time", branch)):
+            continue
+        blend_ids = store.get_blend_ids(branch)
+        if len(blend_ids) == 0 or np.any(blend_ids == ""):
+            continue
+        # `runtime` is per source, so it is summed over the sources in each blend,
+        # while `init time` is per blend (and repeated for each source), so it is only counted once
+        unique_ids, first, inverse = np.unique(blend_ids, return_index=True, return_inverse=True)
+        times = np.bincount(inverse, weights=store.get_column("runtime", branch))
+        times += store.get_column("init time", branch)[first]
+        return dict(zip(unique_ids.tolist(), times.tolist()))
+    return None
+
+
+def run_deblender(
+        deblender: Callable,
+        data: BlendData,
+        return_models: bool = True,
+        model_path: str = None,
+        warm_start_path: str = None,
+        timeout: float = None,
+        render_scene: bool = False,
+        events: str = None,
+) -> tuple:
+    """Deblend a single blend that has already been loaded
+
+    :param deblender: The function used to deblend the blend.
+    :param data: The data for the blend.
+    :param return_models: Whether or not to return the `observation` and `sources`.
+    :param model_path: The directory to save the converged parameters of each
+        source. If `model_path` is `None` then the parameters are not saved.
+    :param warm_start_path: The directory containing the converged parameters
+        of a previous run, used to warm start the sources. The `deblender` is
+        called with a `warm_start` keyword argument (which is `None` if this blend
+        was not saved). If `warm_start_path` is `None` the blend is cold started.
+    :param timeout: The maximum wall clock time (in seconds) to deblend the blend.
+    :param render_scene: Whether or not to render the residual scene of the blend
+        (see `scenes.get_scene`).
+    :param events: The destination of the telemetry events (see `telemetry.open_stream`).
+        A "blend started" event is emitted before the blend is deblended and a
+        "blend finished" (or "blend error") event when it is finished.
+        If `events` is `None` then no events are emitted.
+    :return: tuple (`measurements`, `observation`, `sources`, `scene`, `stats`), where
+        `observation` and `sources` are `None` if `return_models` is `False`
+        and `scene` is `None` if `render_scene` is `False`.
+        If the blend timed out then the first four are `None`.
+        `stats` is the `status` ("ok" or "timeout") of the blend
+        and the cost of deblending it (see `telemetry.get_blend_stats`).
+    """
+    stream = get_event_stream(events)
+    blend_id = str(data.blend_id)
+    stream.emit("blend started", blend_id=blend_id)
+    t0, c0 = time.perf_counter(), time.process_time()
+    try:
+        with time_limit(timeout):
+            if warm_start_path is None:
+                measurements, observation, sources = deblender(data)
+            else:
+                warm_start = load_models(warm_start_path, data.blend_id)
+                measurements, observation, sources = deblender(data, warm_start=warm_start)
+    except BlendTimeout:
+        print("blend {} timed out after {} seconds".format(data.blend_id, timeout))
+        stats = {"status": "timeout", "wall time": time.perf_counter() - t0, "cpu time": time.process_time() - c0}
+        stream.emit("blend finished", blend_id=blend_id, **stats)
+        return None, None, None, None, stats
+    except Exception:
+        stream.emit("blend error", blend_id=blend_id, error=traceback.format_exc())
+        raise
+    stats = {"status": "ok"}
+    stats.update(get_blend_stats(measurements, time.perf_counter() - t0, time.process_time() - c0))
+    stream.emit("blend finished", blend_id=blend_id, **stats)
+    if model_path is not None:
+        save_models(model_path, data.blend_id, deblend.get_parameters(sources))
+    scene = get_scene(observation, sources) if render_scene else None
+    if not return_models:
+        observation = sources = None
+    return measurements, observation, sources, scene, stats
+
+
+def deblend_blend(
+        deblender: Callable,
+        filename: str,
+        return_models: bool = True,
+        keys: Sequence[str] = None,
+        model_path: str = None,
+        warm_start_path: str = None,
+        timeout: float = None,
+        render_scene: bool = False,
+        events: str = None,
+) -> tuple:
+    """Load and deblend a single blend
+
+    This is the unit of work sent to each worker when deblending in parallel,
+    so it must be defined at module level to be picklable.
+
+    :param deblender: The function used to deblend the blend.
+    :param filename: The name of the npz file containing the blend data.
+    :param return_models: Whether or not to return the `observation` and
+        `sources`. These are not always picklable, so they are only
+        shipped back from a worker when they are needed.
+    :param keys: The keys to load from the npz file (see `load_blend`).
+    :param model_path: The directory to save the converged models (see `run_deblender`).
+    :param warm_start_path: The directory of the models used to warm start
+        the blend (see `run_deblender`).
+    :param timeout: The maximum wall clock time (in seconds) to deblend the blend.
+    :param render_scene: Whether or not to render the residual scene of the blend.
+        The scene arrays are always picklable, so this is much cheaper than
+        returning the models when only the residuals are needed.
+    :param events: The destination of the telemetry events (see `run_deblender`).
+        Each worker opens its own stream to the destination.
+    :return: tuple (`measurements`, `observation`, `sources`, `scene`, `stats`) (see `run_deblender`).
+    """
+    data = load_blend(filename, keys)
+    return run_deblender(deblender, data, return_models, model_path, warm_start_path, timeout, render_scene, events)
+
+
+def deblend_blends(
+        deblender: Callable,
+        filenames: List[str],
+        return_models: bool = True,
+        executor: Executor = None,
+        keys: Sequence[str] = None,
+        prefetch: int = 2,
+        model_path: str = None,
+        warm_start_path: str = None,
+        timeout: float = None,
+        costs: Sequence[float] = None,
+        render_scene: bool = False,
+        events: str = None,
+):
+    """Deblend a collection of blends
+
+    :param deblender: The function used to deblend each blend.
+    :param filenames: The npz file for each blend.
+    :param return_models: Whether or not to return the `observation` and
+        `sources` for each blend.
+    :param executor: The executor used to deblend the blends in parallel.
+        If `executor` is `None` then the blends are deblended serially.
+    :param keys: The keys to load from each npz file (see `load_blend`).
+    :param prefetch: The number of blends to load in the background while
+        deblending serially (see `iter_blends`).
+    :param model_path: The directory to save the converged models (see `run_deblender`).
+    :param warm_start_path: The directory of the models used to warm start
+        the blends (see `run_deblender`).
+    :param timeout: The maximum wall clock time (in seconds) to deblend each blend.
+    :param costs: The estimated cost of each blend (see `estimate_costs`).
+        When deblending in parallel the most expensive blends are submitted first,
+        so that a few large blends do not leave a long tail at the end of the run.
+    :param render_scene: Whether or not to render the residual scene of each blend.
+    :param events: The destination of the telemetry events (see `run_deblender`).
+    :return: Generator that yields a tuple (`index`, `result`, `error`) for each blend
+        as soon as it is finished, where `index` is the index of the blend in `filenames`,
+        `result` is the output of `deblend_blend` and `error` is the exception raised
+        while deblending the blend (in which case `result` is `None`).
+        When deblending in parallel the blends are yielded in the order that
+        they finish, so a single slow blend does not hold up the others.
+    """
+    if executor is None:
+        for idx, (data, error) in enumerate(iter_blends(filenames, keys, prefetch, return_errors=True)):
+            if error is not None:
+                yield idx, None, error
+                continue
+            try:
+                result = run_deblender(
+                    deblender, data, return_models, model_path, warm_start_path, timeout, render_scene, events)
+            except Exception as e:
+                yield idx, None, e
+                continue
+            yield idx, result, None
+    else:
+        order = range(len(filenames)) if costs is None else np.argsort(-np.asarray(costs), kind="stable")
+        futures = {}
+        for idx in order:
+            future = executor.submit(
+                deblend_blend, deblender, filenames[idx], return_models, keys, model_path, warm_start_path,
+                timeout, render_scene, events)
+            futures[future] = idx
+        try:
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except BrokenExecutor:
+                    # None of the remaining blends can be deblended
+                    raise
+                except Exception as e:
+                    yield futures[future], None, e
+                    continue
+                yield futures[future], result, None
+        finally:
+            # Cancel the blends that have not started if the generator is closed early
+            # (`Executor.shutdown(cancel_futures=True)` requires python 3.9)
+            for future in futures:
+                future.cancel()
+
+
 def deblend_and_measure(
         set_id: str = None,
         branch: str = None,
@@ -110,6 +854,21 @@ def deblend_and_measure(
         save_residuals: bool = False,
         plot_residuals: bool = False,
         deblender: Callable = None,
+        workers: int = None,
+        executor: Executor = None,
+        use_cache: bool = True,
+        blend_keys: Sequence[str] = None,
+        prefetch: int = 2,
+        save_models: bool = False,
+        warm_start: str = None,
+        timeout: float = None,
+        largest_first: bool = True,
+        scene_workers: int = None,
+        sample: int = None,
+        sample_seed: int = None,
+        events: str = None,
+        verbose: bool = True,
+        skip_failed: bool = False,
 ) -> np.rec.recarray:
     """Deblend an entire test set and store the measurements
 
@@ -120,7 +879,8 @@ def deblend_and_measure(
         (only needed if `save_records` or `save_residuals` is `True`)
     :param overwrite: Whether or not it is ok to rewrite the existing branch
     :param data_path: The path to the blend data. If no `data_path is specified
-        then __BLEND_PATH__ is used.
+        then __BLEND_PATH__ is used. If the blends have been packed into an
+        archive (see `pack_blends`) then they are loaded from the archive.
     :param save_records: Whether or not to save the measurements records.
     :param save_residuals: Whether or not to save the residual plots
         (only necessary when `plot_residuals=True`).
@@ -133,9 +893,66 @@ def deblend_and_measure(
         The function should return a tuple with the following three items:
         
         * `measurements`: The measurement dictionary entry for the blend
+          (or a structured array with the measurements for each source)
         * `observation`: The observation used for deblending.
         * `sources`: The deblended source models.
 
+        When deblending in parallel the `deblender` must be picklable,
+        for example a module level function or a `partial` of one.
+    :param workers: Number of processes used to deblend the blends in parallel.
+        If `workers` is `None` (or `1`) and no `executor` is given then
+        the blends are deblended serially.
+    :param executor: An existing `concurrent.futures.Executor` used to deblend
+        the blends. This takes precedence over `workers` and is not
+        shut down when the deblending is finished.
+    :param use_cache: Whether or not to cache the measurements for each blend
+        in `data/<set_id>/<branch>`. The cache is only used when
+        `save_records` is `True`. Blends that have already been cached with
+        the same deblender configuration are not deblended again, so an
+        interrupted run can be resumed. If `overwrite` is `True` then
+        only the blends cached with a different configuration are removed.
+    :param blend_keys: The arrays to load from each blend file. If `blend_keys`
+        is `None` then only the arrays used by `deblend.deblend` are loaded
+        when deblending with `deblend.deblend`, otherwise all of the arrays are loaded.
+    :param prefetch: The number of blends loaded in a background thread
+        while the current blend is deblended serially.
+    :param save_models: Whether or not to save the converged parameters of the
+        sources in each blend to `data/<set_id>/<branch>/models`, so that they
+        can be used to warm start a later run.
+    :param warm_start: The branch whose saved models are used to initialize the
+        sources. This is a quick "smoke test" mode, so the measurements that depend
+        on the initialization are stored as separate "warm" metrics
+        (see `measure.get_warm_start_name`). The `deblender` must accept a
+        `warm_start` keyword argument.
+    :param timeout: The maximum wall clock time (in seconds) to deblend each blend.
+        Blends that time out are skipped and their IDs are stored with the records.
+    :param largest_first: Whether or not to submit the most expensive blends first
+        when deblending in parallel. The cost is taken from the time each blend took
+        in the latest stored branch, or estimated from the size of the blend.
+    :param scene_workers: Number of processes used to save the residual scenes
+        (when `plot_residuals` and `save_residuals` are `True`). The scenes are
+        rendered in the deblending stage and saved by a separate pool while the
+        remaining blends are deblended. If `scene_workers` is `None` then the scenes
+        are saved by the processes that deblend the blends (or by the current process
+        when deblending serially), so that the run never uses more than `workers` processes.
+    :param sample: The number of blends to deblend in a quick "smoke test" of the set.
+        The blends are a stratified sample (see `sampling.get_sample`), and the
+        statistics of the full set are estimated from the sample (with error bars)
+        and printed. A sample is never saved to the measurement store.
+    :param sample_seed: The seed used to select the sample.
+    :param events: The destination of a stream of JSON lines with the progress of
+        the run, either a filename or "tcp://<host>:<port>" (see `telemetry`).
+        The main process emits "run started", "progress" (after each blend) and
+        "run finished" events, while the process that deblends each blend emits
+        "blend started", "blend finished" and "blend error" events with the stage
+        timings, sources per second and memory of the blend.
+        If `events` is `None` then the progress is only printed.
+    :param verbose: Whether or not to print the progress (latency, throughput,
+        ETA and failures) after each blend and a summary of the run.
+    :param skip_failed: Whether or not to skip the blends that raised an error.
+        Otherwise the remaining blends are still deblended (and cached), but a
+        `ValueError` is raised at the end of the run if any blend failed.
+
     :return: The measurement `records` for each blend.
     """
     if data_path is None:
@@ -143,6 +960,14 @@ def deblend_and_measure(
         blend_ids = get_blend_ids(set_id=set_id)
     else:
         blend_ids = get_blend_ids(path=data_path)
+    if sample is not None:
+        if save_records:
+            raise ValueError("The records for a sample of the blends cannot be saved")
+        from .sampling import get_sample
+        blend_sample = get_sample(set_id, sample, data_path, seed=sample_seed)
+        blend_ids = blend_sample.blend_ids
+        print("deblending a sample of {} of the blends".format(len(blend_ids)))
+    data_path = get_blend_path(data_path)
     if save_records:
         check_data_existence(set_id, branch, overwrite)
     # Use the default `scarlet_extensions` `deblend` if the user hasn't specified their own
@@ -152,45 +977,129 @@ def deblend_and_measure(
             max_iter=settings.max_iter,
             e_rel=settings.e_rel,
         )
+    if blend_keys is None:
+        blend_keys = get_blend_keys(deblender)
+
+    # Paths to save the converged models and load the warm start models
+    model_path = get_model_path(set_id, branch) if save_models else None
+    warm_start_path = None
+    if warm_start is not None:
+        warm_start_path = get_model_path(set_id, warm_start)
+        if not os.path.exists(warm_start_path):
+            msg = "No models have been saved for branch {} in set {}, run it with `save_models=True`"
+            raise ValueError(msg.format(warm_start, set_id))
+
+    # Load any blends that were cached by a previous run
+    cached = {}
+    if use_cache and save_records:
+        config_hash = get_config_hash(deblender, warm_start)
+        cache_path = get_cache_path(set_id, branch)
+        if overwrite:
+            clear_stale_cache(cache_path, config_hash)
+        create_path(cache_path)
+        # Models are not cached, so all of the blends must be deblended to plot residuals
+        if not plot_residuals:
+            for blend_id in blend_ids:
+                measurements = load_cached_blend(cache_path, blend_id, config_hash)
+                # Blends without a saved model have to be deblended again to save it
+                if model_path is not None and not os.path.exists(os.path.join(model_path, "{}.npz".format(blend_id))):
+                    continue
+                if measurements is not None:
+                    cached[blend_id] = measurements
+            if len(cached) > 0:
+                print("loaded {} cached blends from {}".format(len(cached), cache_path))
+    else:
+        cache_path = None
 
     # Deblend the scene
-    all_measurements = []
-
-    num_blends = len(blend_ids)
-    for bidx, blend_id in enumerate(blend_ids):
-        print("blend {} of {}: {}".format(bidx, num_blends, blend_id))
-        print(blend_id)
-        filename = os.path.join(data_path, "{}.npz".format(blend_id))
-        data = np.load(filename)
-        results = deblender(data)
-        measurements, observation, sources = results
-        all_measurements += measurements
-
-        if plot_residuals:
-            import scarlet.display as display
-            images = observation.images
-            norm = display.AsinhMapping(minimum=np.min(images), stretch=np.max(images) * 0.055, Q=10)
-            display.show_scene(sources, observation, show_model=False, show_observed=True, show_rendered=True,
-                               show_residual=True, norm=norm, figsize=(15, 5))
-            plt.suptitle(branch, y=1.05)
-
-            if save_residuals:
-                filename = os.path.join(__SCENE_PATH__, "{}.scene.png".format(blend_id))
-                if os.path.exists(filename):
-                    # Copy the current version as the old filename
-                    new_filename = os.path.join(__SCENE_PATH__, "old_{}.scene.png".format(blend_id))
-                    shutil.move(filename, new_filename)
-                plt.savefig(filename)
-                plt.close()
-            else:
+    dtype = get_record_dtype(deblender, warm_start is not None)
+    builder = RecordBuilder(dtype, capacity=ROWS_PER_BLEND * len(blend_ids))
+    shutdown = False
+    if executor is None and workers is not None and workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        shutdown = True
+
+    deblend_ids = [blend_id for blend_id in blend_ids if blend_id not in cached]
+    filenames = [os.path.join(data_path, "{}.npz".format(blend_id)) for blend_id in deblend_ids]
+    costs = None
+    if largest_first and executor is not None:
+        history = get_blend_history(set_id) if set_id is not None else None
+        costs = estimate_costs(filenames, history)
+    results = deblend_blends(
+        deblender, filenames, False, executor, blend_keys, prefetch,
+        model_path, warm_start_path, timeout, costs, plot_residuals, events,
+    )
+    scene_writer = None
+    if plot_residuals and save_residuals:
+        if scene_workers is None:
+            scene_writer = SceneWriter(__SCENE_PATH__, executor=executor)
+        else:
+            scene_writer = SceneWriter(__SCENE_PATH__, scene_workers)
+    monitor = ProgressMonitor(
+        blend_ids, get_event_stream(events), len(cached), verbose,
+        set_id=set_id, branch=branch, workers=workers if executor is not None else 1,
+    )
+    status = "error"
+    # The blends are reported as they finish, and only put back in order to build the records
+    deblended = {}
+    errors = {}
+    try:
+        for idx, result, error in results:
+            blend_id = deblend_ids[idx]
+            if error is not None:
+                errors[blend_id] = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+                monitor.fail(blend_id, repr(error))
+                continue
+            measurements, _, _, scene, stats = result
+            monitor.update(blend_id, stats)
+            if measurements is None:
+                continue
+            deblended[blend_id] = measurements
+            if cache_path is not None:
+                cache_blend(cache_path, blend_id, config_hash, measurements)
+
+            if scene_writer is not None:
+                scene_writer.submit(blend_id, scene, branch)
+            elif plot_residuals:
+                plot_scene(scene, branch, plt.figure(figsize=(15, 5)))
                 plt.show()
+        status = "ok"
+    finally:
+        monitor.close(status)
+        # Closing the generator cancels the pending blends, so that an error (or Ctrl-C)
+        # only waits for the blends that are already running
+        results.close()
+        # The scenes may be saved by the deblending executor, so they are finished before it is shut down
+        try:
+            if scene_writer is not None:
+                scene_writer.close(cancel=status != "ok")
+                print("saved {} residual scenes, {} were unchanged".format(
+                    len(scene_writer.saved), len(scene_writer.skipped)))
+        finally:
+            if shutdown:
+                executor.shutdown()
 
-    # Combine all of the records together and save
-    _records = [tuple(m.values()) for m in all_measurements]
-    keys = tuple(all_measurements[0].keys())
-    records = np.rec.fromrecords(_records, names=keys)
+    for blend_id in blend_ids:
+        if blend_id in cached:
+            builder.append(cached[blend_id], blend_id)
+        elif blend_id in deblended:
+            builder.append(deblended[blend_id], blend_id)
+    timeouts = [blend_id for blend_id in blend_ids if str(blend_id) in set(monitor.timeouts)]
+    if len(timeouts) > 0:
+        print("{} blends timed out: {}".format(len(timeouts), timeouts))
+    if len(errors) > 0:
+        for blend_id, error in errors.items():
+            print("blend {} failed:\n{}".format(blend_id, error))
+        if not skip_failed:
+            raise ValueError("{} blends failed: {}".format(len(errors), list(errors.keys())))
+    records = builder.records
+    if sample is not None:
+        from .sampling import estimate_statistics, format_estimates
+        estimates = estimate_statistics(records, builder.blend_ids, blend_sample, seed=sample_seed)
+        print("estimated statistics for the full set:")
+        print(format_estimates(estimates))
     # Save the data if a path was provided
     if save_records:
-        np.savez(os.path.join(__DATA_PATH__, set_id, get_filename(branch)), records=records)
+        get_store(set_id).add_branch(branch, records, builder.blend_ids, timeouts)
         save_branch(branch)
     return records
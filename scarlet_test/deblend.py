@@ -1,71 +1,374 @@
+import json
+import os
 import time
-from typing import Dict
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
 
 import numpy as np
-from .measure import measure_blend
+from .measure import measure_blend, append_measurements, get_warm_start_name
+from .instrument import Instrument
 from . import settings
 
 
-def deblend(data: Dict[str, np.ndarray], max_iter: int, e_rel: float):
+# The arrays in each blend file that are used by `deblend` (and `measure_blend`)
+BLEND_KEYS = ("images", "variance", "footprint", "psfs", "centers", "matched")
+# Statistics of the timings measured in repeated trials (see `deblend`)
+TRIAL_STATISTICS = ("min", "median", "spread", "cpu median")
+
+
+def get_trial_columns() -> List[str]:
+    """The names of the columns measured in repeated trials
+
+    :return: A "<timing> <statistic>" column for both the "init time"
+        and "runtime", for each statistic in `TRIAL_STATISTICS`.
+    """
+    return ["{} {}".format(name, stat) for name in ("init time", "runtime") for stat in TRIAL_STATISTICS]
+
+
+def get_record_dtype(
+        filters: str,
+        trace_memory: bool = False,
+        warm_start: bool = False,
+        trials: bool = False,
+) -> np.dtype:
+    """The dtype of the measurements returned by `deblend`
+
+    :param filters: The filter name for each band.
+    :param trace_memory: Whether or not the python memory is traced.
+    :param warm_start: Whether or not the sources are warm started.
+    :param trials: Whether or not the timings are repeated in trials.
+    :return: The dtype of the measurement records.
+    """
+    dtype = [("{} diff".format(f), "<f8") for f in filters]
+    dtype += [
+        ("init time", "<f8"),
+        ("runtime", "<f8"),
+        ("iterations", "<i8"),
+        ("logL", "<f8"),
+        ("init logL", "<f8"),
+        ("match time", "<f8"),
+        ("init sources time", "<f8"),
+        ("fit time", "<f8"),
+        ("log norm time", "<f8"),
+        ("measure time", "<f8"),
+    ]
+    if trace_memory:
+        dtype.append(("peak memory (MB)", "<f8"))
+    dtype.append(("peak RSS (MB)", "<f8"))
+    trial_columns = get_trial_columns()
+    if trials:
+        dtype += [(name, "<f8") for name in trial_columns]
+    if warm_start:
+        dtype = [(get_warm_start_name(name), dt) for name, dt in dtype]
+        dtype.append(("warm sources", "<i8"))
+    return np.dtype(dtype)
+
+
+def get_parameters(sources: Sequence) -> List[List[np.ndarray]]:
+    """Extract the parameters of each source
+
+    :param sources: The deblended sources. Sources that were skipped are `None`.
+    :return: A copy of the parameters of each source (or `None` for skipped sources).
+    """
+    return [None if src is None else [np.array(p) for p in src.parameters] for src in sources]
+
+
+def set_parameters(sources: Sequence, parameters: Sequence[List[np.ndarray]]) -> int:
+    """Initialize the sources with the parameters from a previous fit
+
+    Sources are only initialized if the shapes of all of their
+    parameters match the previous fit.
+
+    :param sources: The initialized sources.
+    :param parameters: The parameters of each source (see `get_parameters`).
+    :return: The number of sources that were initialized from `parameters`.
+    """
+    initialized = 0
+    for src, params in zip(sources, parameters):
+        if src is None or params is None:
+            continue
+        src_params = src.parameters
+        if len(src_params) != len(params) or any(p.shape != q.shape for p, q in zip(src_params, params)):
+            continue
+        for p, q in zip(src_params, params):
+            p[:] = q
+        initialized += 1
+    return initialized
+
+
+def get_trial_statistics(init_times: Sequence[Tuple[float, float]], runtimes: Sequence[Tuple[float, float]]):
+    """Summarize the timings from repeated trials
+
+    :param init_times: The (wall clock, CPU) initialization time of each trial, in ms.
+    :param runtimes: The (wall clock, CPU) runtime of each trial, in ms.
+    :return: Dictionary with the measurements for each column in `get_trial_columns`.
+        The spread is the interquartile range of the wall clock times.
+    """
+    statistics = {}
+    for name, timings in [("init time", init_times), ("runtime", runtimes)]:
+        wall, cpu = np.array(timings, dtype=float).T
+        q1, q3 = np.percentile(wall, [25, 75])
+        statistics["{} min".format(name)] = np.min(wall)
+        statistics["{} median".format(name)] = np.median(wall)
+        statistics["{} spread".format(name)] = q3 - q1
+        statistics["{} cpu median".format(name)] = np.median(cpu)
+    return statistics
+
+
+def get_log_norm(weights: np.ndarray) -> float:
+    """The normalization of the log likelihood of an observation
+
+    This is the constant `N/2 log(2 pi) + sum(log(sigma))/2` that is
+    subtracted from the loss of a blend to give the log likelihood,
+    where only pixels with a positive weight contribute to the sum.
+
+    :param weights: The weights of the observation (`1/sigma**2`).
+    :return: The log likelihood normalization.
+    """
+    cuts = weights > 0
+    log_sigma = -np.sum(np.log(weights[cuts], dtype=np.float64))
+    return weights.size / 2 * np.log(2 * np.pi) + log_sigma / 2
+
+
+def get_weights(data: Dict[str, np.ndarray]) -> np.ndarray:
+    """The weights of the observation of a blend
+
+    :param data: The data for the blend.
+    :return: The inverse variance of each pixel, which is zero in the footprint mask.
+    """
+    return 1 / data["variance"] * ~data["footprint"]
+
+
+def get_blend_metadata(data: Dict[str, np.ndarray]) -> Dict[str, float]:
+    """The metadata stored with each blend when a set is packed into an archive
+
+    :param data: The data for the blend.
+    :return: Dictionary with the `log_norm` of the blend (see `get_log_norm`).
+    """
+    return {"log_norm": float(get_log_norm(get_weights(data)))}
+
+
+def get_blend_key(data: Dict[str, np.ndarray]) -> str:
+    """Identify the file that a blend was loaded from
+
+    The key changes whenever the file is rewritten, so a cached
+    value is never used for a blend whose data has changed,
+    without having to read (or hash) the data itself.
+
+    :param data: The data for the blend.
+    :return: The absolute path, size and modification time of the blend
+        file, or `None` if the blend was not loaded from a file.
+    """
+    filename = getattr(data, "filename", None)
+    if filename is None or not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    return "{}:{}:{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+class LogNormCache:
+    """Cache of the log likelihood normalization of each blend file
+
+    The normalization only depends on the input data, so it is the same for
+    every branch. Blends in an archive store their normalization in the archive
+    (see `get_blend_metadata`), while blends loaded from npz files are cached
+    by the identity of the file (see `get_blend_key`).
+    Each value is appended to a JSON lines file as a single locked write,
+    so caching a blend does not rewrite the file and the values cached by
+    processes running at the same time are never lost.
+    """
+    def __init__(self, filename: str):
+        """Initialize the class
+
+        :param filename: The JSON lines file used to store the normalizations.
+        """
+        self.filename = filename
+        self.values = self.load()
+
+    def load(self) -> Dict[str, float]:
+        """Load the cached normalizations
+
+        :return: Dictionary (blend key, log normalization).
+        """
+        values = {}
+        if not os.path.exists(self.filename):
+            return values
+        with open(self.filename, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Skip a line that was only partially written
+                    continue
+                values[entry["key"]] = entry["log_norm"]
+        return values
+
+    def get(self, key: str) -> float:
+        """Get the cached normalization of a blend
+
+        :param key: The key of the blend (see `get_blend_key`).
+        :return: The normalization, or `None` if it has not been cached.
+        """
+        return self.values.get(key)
+
+    def set(self, key: str, log_norm: float) -> None:
+        """Cache the normalization of a blend
+
+        :param key: The key of the blend (see `get_blend_key`).
+        :param log_norm: The log normalization.
+        """
+        self.values[key] = float(log_norm)
+        path = os.path.dirname(self.filename)
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        line = json.dumps({"key": key, "log_norm": float(log_norm)}) + "\n"
+        with open(self.filename, "a") as f:
+            try:
+                import fcntl
+                fcntl.flock(f, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            f.write(line)
+
+
+_log_norm_cache = None
+
+
+def get_log_norm_cache() -> LogNormCache:
+    """The log normalization cache of the current process
+
+    :return: The cache stored in `data/log_norm.jsonl`.
+    """
+    global _log_norm_cache
+    if _log_norm_cache is None:
+        from .core import __DATA_PATH__
+        _log_norm_cache = LogNormCache(os.path.join(__DATA_PATH__, "log_norm.jsonl"))
+    return _log_norm_cache
+
+
+def deblend(
+        data: Dict[str, np.ndarray],
+        max_iter: int,
+        e_rel: float,
+        profile_path: str = None,
+        trace_memory: bool = False,
+        warm_start: Sequence[List[np.ndarray]] = None,
+        trials: int = 0,
+        warmup: int = 1,
+):
     """Deblend a single blend
 
+    The time spent in each stage (`match`, `init sources`, `fit`, `log norm`
+    and `measure`) is included in the measurements as "<stage> time" (in ms),
+    along with the growth of the RSS while fitting the blend. The memory is
+    measured outside of the window used for the `runtime` and "fit time", while
+    profiling and tracing the python memory slow down the code so much that they
+    are done in separate, untimed passes over the blend.
+
+    A single timing of a blend is noisy, so the blend can also be initialized
+    and fit in repeated `trials`. The trials are run after the blend has been
+    deblended and measured, without profiling or tracing the memory, and the
+    minimum, median and spread (interquartile range) of the wall clock times
+    and the median CPU time are stored as "init time <statistic>" and
+    "runtime <statistic>" (see `get_trial_columns`).
+
     :param data: The numpy dictionary of data to deblend.
     :param max_iter: The maximum number of iterations
     :param e_rel: relative error
+    :param profile_path: Directory to save the `cProfile` statistics
+        for the blend, which is profiled in an extra (untimed) pass.
+        If `profile_path` is `None` then the blend is not profiled.
+    :param trace_memory: Whether or not to trace the peak python memory
+        allocated while fitting the blend (see `Instrument.memory`).
+        This fits the blend an extra time.
+    :param warm_start: The converged parameters of each source from a previous
+        fit (see `get_parameters`), used to initialize the sources. When the sources
+        are warm started every measurement is stored as "warm <name>"
+        (see `get_warm_start_name`) and the number of initialized sources as "warm sources".
+    :param trials: The number of timed trials. If `trials` is zero then
+        the blend is only deblended once.
+    :param warmup: The number of untimed trials to run before the timed trials.
     :return: tuple:
-        * `measurements`: The measurements made on the blend and matched model(s)
+        * `measurements`: Structured array of the measurements made on the blend and matched model(s)
         * `observation`: The observation data.
         * `sources`: The deblended models.
     """
     import scarlet
     from scarlet_extensions.initialization import initAllSources
+    from functools import partial
 
     # Load the sample images
     images = data["images"]
-    mask = data["footprint"]
-    weights = 1 / data["variance"] * ~mask
+    weights = get_weights(data)
     centers = data["centers"]
     psfs = scarlet.PSF(data["psfs"])
     filters = settings.filters
+    if warm_start is not None:
+        warm_start = list(warm_start)
 
-    # Initialize the model, frame, observation, and sources
-    t0 = time.time()
-    from functools import partial
-    model_psf = scarlet.PSF(partial(scarlet.psf.gaussian, sigma=.8), shape=(None, 11, 11))
-
-    model_frame = scarlet.Frame(
-        images.shape,
-        psfs=model_psf,
-        channels=filters)
-
-    observation = scarlet.Observation(
-        images,
-        psfs=psfs,
-        weights=weights,
-        channels=filters)
-    observation.match(model_frame)
-
-    sources, skipped = initAllSources(model_frame, centers, observation, maxComponents=2, edgeDistance=None)
-
-    # Fit the blend
-    t1 = time.time()
-    blend = scarlet.Blend(sources, observation)
-    blend.fit(max_iter, e_rel=e_rel)
-    t2 = time.time()
-
-    if hasattr(observation, "log_norm"):
-        log_norm = observation.log_norm
-    else:
-        _weights = observation.weights
-        _images = observation.images
-        log_sigma = np.zeros(_weights.shape, dtype=_weights.dtype)
-        cuts = _weights > 0
-        log_sigma[cuts] = np.log(1/weights[cuts])
-        log_norm = np.prod(_images.shape)/2 * np.log(2*np.pi)+np.sum(log_sigma)/2
+    def init_and_fit(instrument: Instrument):
+        """Initialize the model, frame, observation and sources, and fit the blend
+
+        :return: The observation, sources, skipped sources, blend, the number
+            of warm started sources, and the (wall clock, CPU) time (in ms)
+            spent initializing and fitting the blend.
+        """
+        t0, c0 = time.perf_counter(), time.process_time()
+        model_psf = scarlet.PSF(partial(scarlet.psf.gaussian, sigma=.8), shape=(None, 11, 11))
+
+        model_frame = scarlet.Frame(
+            images.shape,
+            psfs=model_psf,
+            channels=filters)
+
+        observation = scarlet.Observation(
+            images,
+            psfs=psfs,
+            weights=weights,
+            channels=filters)
+        with instrument.span("match"):
+            observation.match(model_frame)
+
+        warm_sources = 0
+        with instrument.span("init sources"):
+            sources, skipped = initAllSources(model_frame, centers, observation, maxComponents=2, edgeDistance=None)
+            if warm_start is not None:
+                # `warm_start` includes the skipped sources, which are not in `sources`
+                params = [params for k, params in enumerate(warm_start) if k not in skipped]
+                warm_sources = set_parameters(sources, params)
+
+        # Fit the blend. The memory is measured around (and not inside) the timed window.
+        with instrument.memory():
+            t1, c1 = time.perf_counter(), time.process_time()
+            with instrument.span("fit"):
+                blend = scarlet.Blend(sources, observation)
+                blend.fit(max_iter, e_rel=e_rel)
+            t2, c2 = time.perf_counter(), time.process_time()
+        init_time = ((t1 - t0) * 1000, (c1 - c0) * 1000)
+        runtime = ((t2 - t1) * 1000 / len(sources), (c2 - c1) * 1000 / len(sources))
+        return observation, sources, skipped, blend, warm_sources, init_time, runtime
+
+    instrument = Instrument()
+    observation, sources, skipped, blend, warm_sources, init_time, runtime = init_and_fit(instrument)
+
+    with instrument.span("log norm"):
+        if hasattr(observation, "log_norm"):
+            log_norm = observation.log_norm
+        else:
+            # The normalization only depends on the data, so it is only calculated once for each blend
+            log_norm = getattr(data, "metadata", {}).get("log_norm")
+            if log_norm is None:
+                key = get_blend_key(data)
+                cache = get_log_norm_cache()
+                log_norm = cache.get(key) if key is not None else None
+                if log_norm is None:
+                    log_norm = get_log_norm(observation.weights)
+                    if key is not None:
+                        cache.set(key, log_norm)
 
     measurements = {
-        'init time': (t1 - t0) * 1000,
-        'runtime': (t2 - t1) * 1000 / len(sources),
+        'init time': init_time[0],
+        'runtime': runtime[0],
         'iterations': len(blend.loss),
         'logL': blend.loss[-1] - log_norm,
         'init logL': blend.loss[0] - log_norm,
@@ -74,8 +377,39 @@ def deblend(data: Dict[str, np.ndarray], max_iter: int, e_rel: float):
     for k in skipped:
         sources.insert(k, None)
 
-    source_measurements = measure_blend(data, sources, observation.frame.channels)
-    for measurement in source_measurements:
-        measurement.update(measurements)
+    with instrument.span("measure"):
+        source_measurements = measure_blend(data, sources, observation.frame.channels)
+
+    if profile_path is not None:
+        profiler = Instrument(profile_path)
+        profiler.start()
+        _, profile_sources, profile_skipped, *_ = init_and_fit(profiler)
+        for k in profile_skipped:
+            profile_sources.insert(k, None)
+        measure_blend(data, profile_sources, observation.frame.channels)
+        profiler.stop(getattr(data, "blend_id", None))
+
+    if trace_memory:
+        memory = Instrument(trace_memory=True)
+        init_and_fit(memory)
+        # Keep the columns in the same order as `get_record_dtype`
+        instrument.memory_usage = OrderedDict(
+            [("peak memory (MB)", memory.memory_usage["peak memory (MB)"])] + list(instrument.memory_usage.items()))
+
+    if trials > 0:
+        init_times = []
+        runtimes = []
+        for trial in range(warmup + trials):
+            *_, trial_init_time, trial_runtime = init_and_fit(Instrument(trace_memory=False))
+            if trial >= warmup:
+                init_times.append(trial_init_time)
+                runtimes.append(trial_runtime)
+        measurements.update(get_trial_statistics(init_times, runtimes))
+
+    measurements.update(instrument.measurements)
+    source_measurements = append_measurements(source_measurements, measurements)
+    if warm_start is not None:
+        source_measurements.dtype.names = tuple(get_warm_start_name(name) for name in source_measurements.dtype.names)
+        source_measurements = append_measurements(source_measurements, {"warm sources": warm_sources})
 
     return source_measurements, observation, sources
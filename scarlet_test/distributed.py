@@ -0,0 +1,563 @@
+import io
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from functools import partial
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+from . import deblend
+from . import settings
+from .core import (
+    __BLEND_PATH__, get_blend_ids, get_blend_path, get_store, check_data_existence, save_branch,
+    get_blend_keys, get_config_hash, load_blend, run_deblender,
+)
+from .store import ROWS_PER_BLEND, RecordBuilder
+
+
+# A single blend to deblend with a single branch, using the
+# deblender configuration with the hash `config_hash` (see `core.get_config_hash`,
+# without the scarlet version, which is different for each branch)
+Task = namedtuple("Task", ["task_id", "branch", "set_id", "blend_id", "config_hash"])
+
+# The status of a task
+QUEUED = "queued"
+CLAIMED = "claimed"
+DONE = "done"
+TIMEOUT = "timeout"
+FAILED = "failed"
+FINISHED = (DONE, TIMEOUT, FAILED)
+
+
+def to_bytes(measurements) -> bytes:
+    """Serialize the measurements for a blend
+
+    :param measurements: Either a structured array or a list of dictionaries
+        with the measurements for each source in the blend.
+    :return: The measurements saved as an npy file.
+    """
+    if not isinstance(measurements, np.ndarray):
+        names = tuple(measurements[0].keys())
+        measurements = np.rec.fromrecords([tuple(m[name] for name in names) for m in measurements], names=names)
+    f = io.BytesIO()
+    np.save(f, np.asarray(measurements), allow_pickle=False)
+    return f.getvalue()
+
+
+def from_bytes(data: bytes) -> np.ndarray:
+    """Load the measurements serialized with `to_bytes`
+
+    :param data: The serialized measurements.
+    :return: Structured array with the measurements for each source in the blend.
+    """
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class Broker(ABC):
+    """The queue of tasks shared by a coordinator and its workers
+
+    A worker claims a task with a lease, which it renews with `heartbeat`
+    while the task is running. If a worker is lost its lease expires and
+    the task is claimed by another worker, up to `max_attempts` times.
+    This is the interface that every broker implements, so that the
+    distributed runner can use any queue.
+    """
+    def __init__(self, max_attempts: int = 3):
+        """Initialize the class
+
+        :param max_attempts: The maximum number of times a task is claimed
+            before it is marked as failed.
+        """
+        self.max_attempts = max_attempts
+
+    @abstractmethod
+    def put(self, tasks: Sequence[Task]) -> None:
+        """Add tasks to the queue
+
+        Tasks for the same branch, set and blend that are already in the queue are replaced.
+
+        :param tasks: The tasks to add. The `task_id` of each task is ignored.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def claim(self, worker: str, branch: str, lease: float, config_hash: str = None) -> Task:
+        """Claim the next task for a branch
+
+        :param worker: The ID of the worker.
+        :param branch: The branch that the worker deblends with.
+        :param lease: The time (in seconds) that the worker has to
+            finish the task (or renew the lease) before it is claimed
+            by another worker.
+        :param config_hash: The hash of the deblender configuration of the worker.
+            Only tasks submitted with the same configuration are claimed.
+        :return: The claimed task, or `None` if there are no tasks to claim.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_config_hashes(self, branch: str) -> List[str]:
+        """The configurations of the unfinished tasks for a branch
+
+        :param branch: The name of the branch.
+        :return: The (distinct) hash of the deblender configuration
+            of every queued or claimed task for `branch`.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def heartbeat(self, task: Task, worker: str, lease: float) -> bool:
+        """Renew the lease on a task
+
+        :param task: The claimed task.
+        :param worker: The ID of the worker.
+        :param lease: The new lease (in seconds).
+        :return: `True` if the worker still holds the task.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def complete(self, task: Task, result: bytes, status: str = DONE) -> None:
+        """Store the result of a task
+
+        :param task: The claimed task.
+        :param result: The serialized measurements (see `to_bytes`).
+        :param status: The status of the finished task (`DONE` or `TIMEOUT`).
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def fail(self, task: Task, worker: str, error: str) -> None:
+        """Release a task that raised an error
+
+        The task is queued again, unless it has already been
+        claimed `max_attempts` times.
+
+        :param task: The claimed task.
+        :param worker: The ID of the worker.
+        :param error: The error message.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_counts(self, branch: str = None, set_id: str = None) -> Dict[str, int]:
+        """The number of tasks with each status
+
+        :param branch: Only count the tasks for this branch.
+        :param set_id: Only count the tasks for this set.
+        :return: Dictionary (status, number of tasks).
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_results(self, branch: str, set_id: str) -> Dict[str, tuple]:
+        """The results of the tasks for a branch and set
+
+        :param branch: The name of the branch.
+        :param set_id: ID of the set.
+        :return: Dictionary (blend ID, (status, result, error)) for each task.
+        """
+        raise NotImplementedError()
+
+
+class SQLiteBroker(Broker):
+    """Broker that stores the queue in a SQLite database
+
+    This works without any external services, for workers on a single
+    machine or on machines that share a file system. Every operation opens
+    its own connection, so the broker can be shared by threads and processes.
+    """
+    def __init__(self, filename: str, max_attempts: int = 3, timeout: float = 60):
+        """Initialize the class
+
+        :param filename: The name of the database.
+        :param max_attempts: The maximum number of times a task is claimed
+            before it is marked as failed.
+        :param timeout: The time (in seconds) to wait for another
+            process to release a lock on the database.
+        """
+        super().__init__(max_attempts)
+        self.filename = filename
+        self.timeout = timeout
+        connection = self._connect()
+        try:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    branch TEXT NOT NULL,
+                    set_id TEXT NOT NULL,
+                    blend_id TEXT NOT NULL,
+                    config_hash TEXT,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result BLOB,
+                    error TEXT,
+                    UNIQUE (branch, set_id, blend_id)
+                )
+            """)
+            # Queues created before the tasks had a configuration
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(tasks)")]
+            if "config_hash" not in columns:
+                connection.execute("ALTER TABLE tasks ADD COLUMN config_hash TEXT")
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection to the database"""
+        return sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+
+    def _execute(self, query: str, parameters: Sequence = ()) -> List[tuple]:
+        """Run a query in its own transaction
+
+        :param query: The SQL query.
+        :param parameters: The parameters of the query.
+        :return: The rows returned by the query.
+        """
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(query, parameters).fetchall()
+            connection.execute("COMMIT")
+            return rows
+        finally:
+            connection.close()
+
+    def put(self, tasks: Sequence[Task]) -> None:
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT OR REPLACE INTO tasks (branch, set_id, blend_id, config_hash, status) VALUES (?, ?, ?, ?, ?)",
+                [(task.branch, task.set_id, str(task.blend_id), task.config_hash, QUEUED) for task in tasks],
+            )
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def claim(self, worker: str, branch: str, lease: float, config_hash: str = None) -> Task:
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            # Tasks whose worker was lost too many times have failed
+            connection.execute(
+                "UPDATE tasks SET status = ?, error = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, "The lease expired {} times".format(self.max_attempts), CLAIMED, now, self.max_attempts),
+            )
+            row = connection.execute(
+                "SELECT task_id, branch, set_id, blend_id, config_hash FROM tasks "
+                "WHERE branch = ? AND config_hash IS ? AND (status = ? OR (status = ? AND lease_expires < ?)) "
+                "ORDER BY task_id LIMIT 1",
+                (branch, config_hash, QUEUED, CLAIMED, now),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE tasks SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE task_id = ?",
+                    (CLAIMED, worker, now + lease, row[0]),
+                )
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        return None if row is None else Task(*row)
+
+    def get_config_hashes(self, branch: str) -> List[str]:
+        rows = self._execute(
+            "SELECT DISTINCT config_hash FROM tasks WHERE branch = ? AND status IN (?, ?)",
+            (branch, QUEUED, CLAIMED),
+        )
+        return [row[0] for row in rows]
+
+    def heartbeat(self, task: Task, worker: str, lease: float) -> bool:
+        self._execute(
+            "UPDATE tasks SET lease_expires = ? WHERE task_id = ? AND worker = ? AND status = ?",
+            (time.time() + lease, task.task_id, worker, CLAIMED),
+        )
+        rows = self._execute("SELECT worker, status FROM tasks WHERE task_id = ?", (task.task_id,))
+        return len(rows) > 0 and rows[0] == (worker, CLAIMED)
+
+    def complete(self, task: Task, result: bytes, status: str = DONE) -> None:
+        # The result is kept even if the lease expired, as long as no other worker has finished the task
+        self._execute(
+            "UPDATE tasks SET status = ?, result = ?, error = NULL WHERE task_id = ? AND status NOT IN (?, ?)",
+            (status, result, task.task_id, DONE, TIMEOUT),
+        )
+
+    def fail(self, task: Task, worker: str, error: str) -> None:
+        self._execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, worker = NULL "
+            "WHERE task_id = ? AND worker = ? AND status = ?",
+            (self.max_attempts, FAILED, QUEUED, error, task.task_id, worker, CLAIMED),
+        )
+
+    def get_counts(self, branch: str = None, set_id: str = None) -> Dict[str, int]:
+        query = "SELECT status, COUNT(*) FROM tasks WHERE (? IS NULL OR branch = ?) AND (? IS NULL OR set_id = ?) " \
+                "GROUP BY status"
+        return dict(self._execute(query, (branch, branch, set_id, set_id)))
+
+    def get_results(self, branch: str, set_id: str) -> Dict[str, tuple]:
+        rows = self._execute(
+            "SELECT blend_id, status, result, error FROM tasks WHERE branch = ? AND set_id = ?",
+            (branch, set_id),
+        )
+        return {row[0]: row[1:] for row in rows}
+
+
+def get_default_deblender() -> Callable:
+    """The deblender used by the workers if no deblender is given
+
+    :return: `deblend.deblend` with the `settings` for the tests.
+    """
+    return partial(
+        deblend.deblend,
+        max_iter=settings.max_iter,
+        e_rel=settings.e_rel,
+    )
+
+
+def get_worker_id() -> str:
+    """A unique ID for the current process
+
+    :return: "<host name>:<process ID>"
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def check_config(broker: Broker, branch: str, config_hash: str) -> None:
+    """Check that a worker has the same configuration as the tasks for its branch
+
+    :param broker: The queue of tasks.
+    :param branch: The branch installed for the worker.
+    :param config_hash: The hash of the deblender configuration of the worker.
+    """
+    mismatched = [task_hash for task_hash in broker.get_config_hashes(branch) if task_hash != config_hash]
+    if len(mismatched) > 0:
+        msg = "The worker configuration ({}) does not match the configuration of the tasks for {} ({})"
+        raise ValueError(msg.format(config_hash, branch, ", ".join(str(task_hash) for task_hash in mismatched)))
+
+
+class Heartbeat:
+    """Context manager that renews the lease on a task in a background thread
+
+    An error renewing the lease (for example if the database is locked)
+    is printed and the lease is renewed again at the next heartbeat, so
+    that the lease does not expire while the task is still running.
+    """
+    def __init__(self, broker: Broker, task: Task, worker: str, lease: float):
+        """Initialize the class
+
+        :param broker: The broker that the task was claimed from.
+        :param task: The claimed task.
+        :param worker: The ID of the worker.
+        :param lease: The lease (in seconds). The lease is renewed
+            three times for each `lease`.
+        """
+        self.broker = broker
+        self.task = task
+        self.worker = worker
+        self.lease = lease
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.lease / 3):
+            try:
+                self.broker.heartbeat(self.task, self.worker, self.lease)
+            except Exception as e:
+                print("{} could not renew the lease on blend {}: {}".format(self.worker, self.task.blend_id, e))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(
+        broker: Broker,
+        branch: str,
+        deblender: Callable = None,
+        worker: str = None,
+        lease: float = 600,
+        poll: float = 10,
+        timeout: float = None,
+        data_path: str = None,
+        events: str = None,
+) -> int:
+    """Deblend the tasks for a branch until the queue is finished
+
+    The worker keeps polling for tasks while any task for the branch
+    is still claimed, in case the worker that claimed it is lost.
+    Workers only claim tasks that were submitted with the same deblender
+    configuration, and a `ValueError` is raised if the tasks for the
+    branch were submitted with a different configuration, so that
+    the records of a branch never mix configurations.
+
+    :param broker: The queue of tasks.
+    :param branch: The branch installed for this worker.
+        Only tasks for `branch` are claimed.
+    :param deblender: The function used to deblend (see `deblend_and_measure`).
+    :param worker: The ID of the worker. If `worker` is `None` then `get_worker_id` is used.
+    :param lease: The time (in seconds) that a task is held without a heartbeat.
+    :param poll: The time (in seconds) to wait when there are no tasks to claim.
+    :param timeout: The maximum wall clock time (in seconds) to deblend each blend.
+    :param data_path: The directory containing the blends for each set.
+        If `data_path` is `None` then `__BLEND_PATH__` is used.
+    :param events: The destination of the telemetry events for each blend
+        (see `core.run_deblender`).
+    :return: The number of tasks finished by the worker.
+    """
+    if deblender is None:
+        deblender = get_default_deblender()
+    if worker is None:
+        worker = get_worker_id()
+    if data_path is None:
+        data_path = __BLEND_PATH__
+    keys = get_blend_keys(deblender)
+    config_hash = get_config_hash(deblender, include_version=False)
+    finished = 0
+    while True:
+        task = broker.claim(worker, branch, lease, config_hash)
+        if task is None:
+            check_config(broker, branch, config_hash)
+            counts = broker.get_counts(branch)
+            if counts.get(QUEUED, 0) + counts.get(CLAIMED, 0) == 0:
+                break
+            time.sleep(poll)
+            continue
+        print("{} deblending blend {} in {}".format(worker, task.blend_id, task.set_id))
+        filename = os.path.join(get_blend_path(os.path.join(data_path, task.set_id)), "{}.npz".format(task.blend_id))
+        with Heartbeat(broker, task, worker, lease):
+            try:
+                data = load_blend(filename, keys)
+                measurements, *_ = run_deblender(deblender, data, False, timeout=timeout, events=events)
+            except Exception:
+                broker.fail(task, worker, traceback.format_exc())
+                continue
+        if measurements is None:
+            broker.complete(task, None, TIMEOUT)
+        else:
+            broker.complete(task, to_bytes(measurements))
+        finished += 1
+    return finished
+
+
+class Coordinator:
+    """Split the sets for each branch into tasks and assemble the results
+
+    Each (branch, set, blend ID) is a separate task, which is deblended by
+    a worker running `run_worker` with the branch installed. Once all of the
+    tasks are finished the measurements are assembled into the same records
+    that `deblend_and_measure` saves.
+    """
+    def __init__(self, broker: Broker):
+        """Initialize the class
+
+        :param broker: The queue of tasks.
+        """
+        self.broker = broker
+
+    def submit(
+            self,
+            set_ids: Sequence[str],
+            branches: Sequence[str],
+            overwrite: bool = False,
+            deblender: Callable = None,
+    ) -> int:
+        """Queue the tasks for every blend in each set for each branch
+
+        :param set_ids: IDs of the sets to deblend.
+        :param branches: The branches to test.
+        :param overwrite: Whether or not it is ok to rewrite existing branches.
+        :param deblender: The function that the workers must deblend with.
+            If `deblender` is `None` then `get_default_deblender` is used.
+        :return: The number of tasks queued.
+        """
+        if deblender is None:
+            deblender = get_default_deblender()
+        config_hash = get_config_hash(deblender, include_version=False)
+        tasks = []
+        for set_id in set_ids:
+            blend_ids = get_blend_ids(set_id=set_id)
+            for branch in branches:
+                check_data_existence(set_id, branch, overwrite)
+                tasks += [Task(None, branch, set_id, str(blend_id), config_hash) for blend_id in blend_ids]
+        self.broker.put(tasks)
+        print("queued {} tasks".format(len(tasks)))
+        return len(tasks)
+
+    def wait(self, set_ids: Sequence[str], branches: Sequence[str], poll: float = 10) -> None:
+        """Wait for all of the tasks to finish
+
+        :param set_ids: IDs of the sets that were submitted.
+        :param branches: The branches that were submitted.
+        :param poll: The time (in seconds) between checks of the queue.
+        """
+        while True:
+            counts = {}
+            for set_id in set_ids:
+                for branch in branches:
+                    for status, count in self.broker.get_counts(branch, set_id).items():
+                        counts[status] = counts.get(status, 0) + count
+            total = sum(counts.values())
+            finished = sum(counts.get(status, 0) for status in FINISHED)
+            print("{} of {} tasks finished ({} timed out, {} failed)".format(
+                finished, total, counts.get(TIMEOUT, 0), counts.get(FAILED, 0)))
+            if finished == total:
+                return
+            time.sleep(poll)
+
+    def assemble(
+            self,
+            set_id: str,
+            branch: str,
+            save_records: bool = True,
+            skip_failed: bool = False,
+    ) -> np.rec.recarray:
+        """Assemble the measurements for a branch in a set
+
+        :param set_id: ID of the set.
+        :param branch: The name of the branch.
+        :param save_records: Whether or not to save the records
+            in the measurement store (see `deblend_and_measure`).
+        :param skip_failed: Whether or not to skip the blends that failed.
+            Otherwise a `ValueError` is raised if any blend failed.
+        :return: The measurement `records` for each blend, in the same
+            order as `deblend_and_measure`.
+        """
+        results = self.broker.get_results(branch, set_id)
+        blend_ids = [str(blend_id) for blend_id in get_blend_ids(set_id=set_id)]
+        missing = [blend_id for blend_id in blend_ids if results.get(blend_id, (None,))[0] not in FINISHED]
+        if len(missing) > 0:
+            raise ValueError("{} blends in {} for branch {} have not finished".format(len(missing), set_id, branch))
+        failed = [blend_id for blend_id in blend_ids if results[blend_id][0] == FAILED]
+        if len(failed) > 0:
+            for blend_id in failed:
+                print("blend {} failed:\n{}".format(blend_id, results[blend_id][2]))
+            if not skip_failed:
+                raise ValueError("{} blends failed in {} for branch {}".format(len(failed), set_id, branch))
+
+        builder = RecordBuilder(capacity=ROWS_PER_BLEND * len(blend_ids))
+        timeouts = []
+        for blend_id in blend_ids:
+            status, result, _ = results[blend_id]
+            if status == TIMEOUT:
+                timeouts.append(blend_id)
+            elif status == DONE:
+                builder.append(from_bytes(result), blend_id)
+        records = builder.records
+        if save_records:
+            get_store(set_id).add_branch(branch, records, builder.blend_ids, timeouts)
+            save_branch(branch)
+        return records
@@ -0,0 +1,174 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict
+
+
+# Held while the memory of a stage is measured (see `Instrument.memory`). The RSS is
+# measured for the whole process, so other threads that allocate memory (for example
+# the prefetching in `core.iter_blends`) hold it too, and wait until the measurement is finished.
+MEMORY_LOCK = threading.Lock()
+
+
+def _read_status(key: str) -> float:
+    """Read a memory entry (in kB) of `/proc/self/status`
+
+    :param key: The name of the entry, for example "VmRSS".
+    :return: The value in MB, or `NaN` if it cannot be read.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+def get_rss() -> float:
+    """The current resident set size of the process
+
+    :return: The RSS in MB, or `NaN` if it cannot be measured on the current platform.
+    """
+    return _read_status("VmRSS")
+
+
+def get_peak_rss() -> float:
+    """The high-water mark of the resident set size of the current process
+
+    This is the peak since the process started, or since it was last
+    reset with `reset_peak_rss`, so on its own it is not a per-blend value.
+
+    :return: The peak RSS in MB, or `NaN` if it cannot be measured on
+        the current platform.
+    """
+    peak = _read_status("VmHWM")
+    if peak == peak:
+        return peak
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports the peak RSS in kB while macOS reports it in bytes
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the high-water mark of the RSS to the current RSS
+
+    This is only possible on Linux, by writing "5" to `/proc/self/clear_refs`.
+
+    :return: Whether or not the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+class Instrument:
+    """Instrumentation for deblending a single blend
+
+    Each stage of the deblending is timed with `span`, and the total time
+    spent in each span is stored as a "<name> time" measurement (in ms),
+    so that it can be plotted like any other `Metric`.
+    The peak memory used by a stage is measured with `memory`,
+    and optionally the blend can also be profiled with `cProfile`.
+    """
+    def __init__(self, profile_path: str = None, trace_memory: bool = False):
+        """Initialize the class
+
+        :param profile_path: Directory to save the `cProfile` statistics for
+            each blend. If `profile_path` is `None` then the blend is not profiled.
+        :param trace_memory: Whether or not to measure the peak memory
+            allocated by python (with `tracemalloc`) in `memory`.
+            Tracing the memory slows down the code being traced, so it should
+            not be used while timing a stage, while the peak RSS is always measured.
+        """
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        self.spans = OrderedDict()
+        self.memory_usage = OrderedDict()
+        self._profiler = None
+
+    @contextmanager
+    def span(self, name: str):
+        """Time a stage of the deblending
+
+        :param name: The name of the stage.
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0) + (time.perf_counter() - t0) * 1000
+
+    @contextmanager
+    def memory(self):
+        """Measure the peak memory used by a stage of the deblending
+
+        The peak memory allocated by python during the stage is stored as
+        "peak memory (MB)" and the growth of the process RSS, from the start of the
+        stage to its high-water mark, as "peak RSS (MB)". The peak RSS can only
+        be reset on Linux, so on other platforms it is `NaN`.
+        Other threads are paused with `MEMORY_LOCK` while the memory is measured.
+        """
+        with MEMORY_LOCK:
+            tracing = False
+            if self.trace_memory:
+                import tracemalloc
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    tracing = True
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+                else:
+                    # Python < 3.9: clearing the traces also resets the peak
+                    tracemalloc.clear_traces()
+                traced = tracemalloc.get_traced_memory()[0]
+            rss = get_rss() if reset_peak_rss() else float("nan")
+            try:
+                yield
+            finally:
+                if self.trace_memory:
+                    self.memory_usage["peak memory (MB)"] = (tracemalloc.get_traced_memory()[1] - traced) / 1024**2
+                    if tracing:
+                        tracemalloc.stop()
+                self.memory_usage["peak RSS (MB)"] = get_peak_rss() - rss
+
+    def start(self) -> None:
+        """Start profiling (if required)"""
+        if self.profile_path is not None:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self, blend_id: str = None) -> None:
+        """Stop profiling and save the profile
+
+        :param blend_id: The ID of the blend, used to name the profile.
+        """
+        if self._profiler is not None:
+            self._profiler.disable()
+            if not os.path.exists(self.profile_path):
+                os.makedirs(self.profile_path, exist_ok=True)
+            if blend_id is None:
+                blend_id = "blend_{}_{}".format(os.getpid(), int(time.time()*1000))
+            self._profiler.dump_stats(os.path.join(self.profile_path, "{}.prof".format(blend_id)))
+            self._profiler = None
+
+    @property
+    def measurements(self) -> Dict[str, float]:
+        """The time spent in each span, in ms, and the memory usage"""
+        measurements = OrderedDict(("{} time".format(name), value) for name, value in self.spans.items())
+        measurements.update(self.memory_usage)
+        return measurements
@@ -1,87 +1,323 @@
 import os
+import re
+import json
+import hashlib
+from collections import OrderedDict
 from typing import List, Sequence, Dict, Tuple, Union
 
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import ticker as mticker
 
-from .core import __DATA_PATH__, get_filename, get_branches
+from .core import __BRANCH_FILE__, get_store, get_store_path, get_branches
+from .store import MeasurementStore, BranchRecords
 
 
-def adjacent_values(vals: np.ndarray, q1: int, q3: int) -> Tuple[np.ndarray, np.ndarray]:
-    """Get adjacent values for whiskers
+# Version of the plotting code, which is part of the hash of each plot (see `get_plot_hash`).
+# Increase it whenever a change to `Metric.plot` changes the plots, so that they are rendered again.
+PLOT_VERSION = 1
 
-    :param vals: The array that is being plotted
-    :param q1: The lower quartile
-    :param q3: The upper quartile
-    :return: lower whisker and upper whisker value
+# Every measurement of a warm started blend depends on how the sources were initialized
+# (including the stage timings, memory and flux differences), so they are all stored
+# as "warm <name>", and are never compared to the measurements of cold started blends.
+WARM_START_PREFIX = "warm "
+
+
+def get_warm_start_name(name: str) -> str:
+    """The name of a measurement when the sources are warm started
+
+    :param name: The name of the measurement of a cold started blend.
+    :return: The name of the measurement of a warm started blend.
     """
-    upper_adjacent_value = q3 + (q3 - q1) * 1.5
-    upper_adjacent_value = np.clip(upper_adjacent_value, q3, vals[-1])
+    return WARM_START_PREFIX + name
 
-    lower_adjacent_value = q1 - (q3 - q1) * 1.5
-    lower_adjacent_value = np.clip(lower_adjacent_value, vals[0], q1)
-    return lower_adjacent_value, upper_adjacent_value
+
+def match_centers(centers: np.ndarray, matched_centers: np.ndarray) -> np.ndarray:
+    """Match each true source to its detected source
+
+    Each center is converted into a single integer key and the detected centers
+    are sorted, so that all of the true centers are matched at once
+    with a binary search instead of comparing every pair of centers.
+
+    :param centers: The (y, x) center of each detected source.
+    :param matched_centers: The (y, x) center of each true source.
+    :return: The index in `centers` of each true source. If multiple detected
+        sources have the same center then the first one is used.
+    """
+    if len(matched_centers) == 0:
+        return np.zeros(0, dtype=int)
+    all_centers = np.concatenate([centers, matched_centers])
+    offset = np.min(all_centers, axis=0)
+    width = np.max(all_centers[:, 1]) - offset[1] + 1
+    keys = (centers[:, 0] - offset[0]) * width + (centers[:, 1] - offset[1])
+    matched_keys = (matched_centers[:, 0] - offset[0]) * width + (matched_centers[:, 1] - offset[1])
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    idx = np.clip(np.searchsorted(sorted_keys, matched_keys), 0, len(keys) - 1)
+    unmatched = sorted_keys[idx] != matched_keys
+    if np.any(unmatched):
+        msg = "Could not find a detected source at {}"
+        raise ValueError(msg.format(matched_centers[unmatched].tolist()))
+    return order[idx]
+
+
+def append_measurements(records: np.ndarray, measurements: Dict[str, float]) -> np.ndarray:
+    """Add the same measurements to every row in a structured array
+
+    :param records: The measurements for each source.
+    :param measurements: The measurements to add to every source.
+    :return: A new structured array with the columns from `records`
+        followed by a column for each item in `measurements`.
+    """
+    names = [name for name in measurements if name not in records.dtype.names]
+    dtype = records.dtype.descr + [(name, np.asarray(measurements[name]).dtype.str) for name in names]
+    result = np.zeros(len(records), dtype=dtype)
+    for name in records.dtype.names:
+        result[name] = records[name]
+    for name, value in measurements.items():
+        result[name] = value
+    return result
 
 
 def measure_blend(
         data: Dict[str, np.ndarray],
         sources: List,
         filters: Sequence[str],
-) -> List[Dict[str, float]]:
+) -> np.ndarray:
     """
     Measure all of the fake sources in a single blend
 
     :param data: The numpy file with blend data
     :param sources: The sources in the blend
     :param filters: The filter name for each band
-    :return: List of measurements for each matched source
+    :return: Structured array with the measurements for each matched source
     """
     import scarlet.measure
 
     # Extract necessary fields from the data
     centers = data["centers"]
     matched = data["matched"]
-    matched_centers = np.array([[m["y"], m["x"]] for m in matched]).astype(int)
+    matched_centers = np.stack([matched["y"], matched["x"]], axis=1).astype(int)
 
-    true_flux = np.array([matched[f + "magVar"] for f in filters])
+    # Get the matching index for each source based on its center
+    matched_idx = match_centers(centers, matched_centers)
 
-    measurements = []
-    for k, (cy, cx) in enumerate(matched_centers):
-        # Get the matching index for the source based on its center
-        matched_idx = np.where((centers[:, 0] == cy) & (centers[:, 1] == cx))[0][0]
+    # Calculate the flux difference for all sources in all bands
+    true_flux = np.array([matched[f + "magVar"] for f in filters]).T
+    flux = np.array([scarlet.measure.flux(sources[idx]) for idx in matched_idx]).reshape(-1, len(filters))
+    diff = true_flux - (27 - 2.5*np.log10(flux))
 
-        # Calculate the flux difference in each band
-        source = sources[matched_idx]
-        flux = 27 - 2.5*np.log10(scarlet.measure.flux(source))
+    measurements = np.zeros(len(matched_idx), dtype=[(f + " diff", "<f8") for f in filters])
+    for f, band in enumerate(filters):
+        measurements[band + " diff"] = diff[:, f]
+    return measurements
 
-        diff = true_flux[:, k] - flux
 
-        measurement = {filters[f] + " diff": diff[f] for f in range(len(filters))}
-        measurements.append(measurement)
+class MeasurementCache:
+    """Process level cache of the measurements for each set
 
-    return measurements
+    Each set is only loaded once and the same read-only views of the
+    records are handed out to every `Metric`. A set is reloaded if either
+    `branches.json` or the measurement store for the set has been modified
+    since it was loaded.
+    """
+    def __init__(self, max_sets: int = 4):
+        """Initialize the class
+
+        :param max_sets: The maximum number of sets to keep in memory.
+            When the cache is full the least recently used set is dropped.
+        """
+        self.max_sets = max_sets
+        self._sets = OrderedDict()
+
+    @staticmethod
+    def get_mtimes(set_id: str) -> Tuple[float, float]:
+        """The modification times of the files that a set depends on
 
+        :param set_id: ID of the set
+        :return: The modification time of `branches.json` and the store index.
+        """
+        mtimes = []
+        for filename in [__BRANCH_FILE__, os.path.join(get_store_path(set_id), MeasurementStore.index_file)]:
+            mtimes.append(os.path.getmtime(filename) if os.path.exists(filename) else None)
+        return tuple(mtimes)
+
+    def load(self, set_id: str) -> Dict[str, BranchRecords]:
+        """Load the measurements for a set
+
+        :param set_id: ID of the set
+        :return: Dictionary (branch name, records) of read-only records
+            for each branch, in the order that the branches were merged.
+            Branches that have been compacted are `BranchSummary` views.
+        """
+        mtimes = self.get_mtimes(set_id)
+        if set_id in self._sets and self._sets[set_id][0] == mtimes:
+            self._sets.move_to_end(set_id)
+            return self._sets[set_id][1]
 
-def check_log(data: np.ndarray, ax: plt.axis):
-    """Check to see if the data should use a log scale
+        store = get_store(set_id)
+        measurements = OrderedDict(
+            (branch, store.get_branch(branch))
+            for branch in get_branches() if branch in store.branches or branch in store.compacted_branches
+        )
+        self._sets[set_id] = (mtimes, measurements)
+        self._sets.move_to_end(set_id)
+        while len(self._sets) > self.max_sets:
+            self._sets.popitem(last=False)
+        return measurements
+
+    def clear(self) -> None:
+        """Remove all of the sets from the cache"""
+        self._sets.clear()
+
+
+_measurement_cache = MeasurementCache()
+
+
+def load_measurements(set_id: str) -> Dict[str, BranchRecords]:
+    """Load the measurements for a set using the shared `MeasurementCache`
+
+    :param set_id: ID of the set
+    :return: Dictionary (branch name, records) of read-only records
+        for each branch, in the order that the branches were merged.
+    """
+    return _measurement_cache.load(set_id)
+
+
+def set_log_ticks(ax: plt.axis, ymin: float, ymax: float) -> None:
+    """Label the y-axis of a plot whose data is `log10` of the measurements
 
-    :param data: array that is being plotted
     :param ax: The axis that contains the plot
-    :return: Whether or not to use a log scale
+    :param ymin: The minimum `log10` value of the data
+    :param ymax: The maximum `log10` value of the data
+    """
+    ymin = int(np.max([1e-50, ymin - 1]))
+    ymax = int(ymax+1)
+    ax.yaxis.set_major_formatter(mticker.StrMethodFormatter("$10^{{{x:.0f}}}$"))
+    ax.yaxis.set_ticks([
+        np.log10(x) for p in range(ymin, ymax)
+        for x in np.linspace(10 ** p, 10 ** (p + 1), 10)], minor=True)
+
+
+def has_column(records: BranchRecords, name: str) -> bool:
+    """Check whether or not a column has been measured for a branch
+
+    `in` on a numpy structured array compares the values of the
+    records, not the field names, so the dtype is used instead.
+
+    :param records: The records (or summary) of a branch.
+    :param name: The name of the column.
+    :return: Whether or not `records` contains the column.
     """
-    _data = np.log10(data)
-    ymin, ymax = np.min(_data), np.max(_data)
+    if isinstance(records, np.ndarray):
+        return records.dtype.names is not None and name in records.dtype.names
+    return name in records
+
+
+def stack_columns(
+        measurements: Dict[str, np.rec.recarray],
+        names: Sequence[str],
+        branches: Sequence[str],
+) -> np.ndarray:
+    """Stack the columns for multiple metrics and branches into a single array
+
+    :param measurements: Dictionary (branch name, measurments)
+        of measurements for each branch.
+    :param names: The names of the columns to stack.
+    :param branches: The branches to stack.
+    :return: Array with shape (metrics, branches, rows). If the branches
+        have a different number of rows then the shorter ones are
+        padded with `NaN`.
+    """
+    rows = np.max([len(measurements[branch][names[0]]) for branch in branches])
+    data = np.full((len(names), len(branches), rows), np.nan)
+    for m, name in enumerate(names):
+        for b, branch in enumerate(branches):
+            column = measurements[branch][name]
+            data[m, b, :len(column)] = column
+    return data
+
+
+def get_log_range(data: np.ndarray, axis: Union[int, Tuple[int, ...]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Calculate the range of `log10(data)`, ignoring `NaN` padding
+
+    The range is `NaN` if any of the measurements
+    are negative, so a log scale is never used.
+
+    :param data: The stacked measurements (see `stack_columns`).
+    :param axis: The axis (or axes) to calculate the range over.
+    :return: The minimum and maximum of `log10(data)`
+    """
+    valid = ~np.isnan(data)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_data = np.log10(data)
+    ymin = np.min(np.where(valid, log_data, np.inf), axis=axis)
+    ymax = np.max(np.where(valid, log_data, -np.inf), axis=axis)
+    return ymin, ymax
+
+
+def get_statistics(
+        measurements: Dict[str, np.rec.recarray],
+        names: Sequence[str],
+        plot_branches: Sequence[str],
+        scatter_branches: Sequence[str],
+) -> Dict[str, Dict]:
+    """Calculate the statistics for multiple metrics at once
+
+    All of the metrics and branches are stacked into a single array, so
+    that the log scale, quartiles and whiskers for every metric are
+    calculated in a single vectorized pass.
+
+    :param measurements: Dictionary (branch name, measurments)
+        of measurements for each branch.
+    :param names: The names of the metrics. Every branch must contain
+        all of the metrics.
+    :param plot_branches: The branches used in the box and violin plots.
+    :param scatter_branches: The branches used in the scatter plot.
+    :return: Dictionary (metric name, statistics) with the data and statistics
+        needed by `Metric.draw` for each metric.
+    """
+    # Statistics for the box and violin plots
+    data = stack_columns(measurements, names, plot_branches)
+    ymin, ymax = get_log_range(data, axis=(1, 2))
     # Use a log scale if the range is more than 2 orders of magnitude
-    if ymax - ymin > 2:
-        ymin = int(np.max([1e-50, ymin - 1]))
-        ymax = int(ymax+1)
-        ax.yaxis.set_major_formatter(mticker.StrMethodFormatter("$10^{{{x:.0f}}}$"))
-        ax.yaxis.set_ticks([
-            np.log10(x) for p in range(ymin, ymax)
-            for x in np.linspace(10 ** p, 10 ** (p + 1), 10)], minor=True)
-        return True
-    return False
+    islog = ymax - ymin > 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        data = np.where(islog[:, None, None], np.log10(data), data)
+    quartile1, medians, quartile3 = np.nanpercentile(data, [25, 50, 75], axis=2)
+    iqr = quartile3 - quartile1
+    whiskers_min = np.clip(quartile1 - iqr * 1.5, np.nanmin(data, axis=2), quartile1)
+    whiskers_max = np.clip(quartile3 + iqr * 1.5, quartile3, np.nanmax(data, axis=2))
+
+    # Statistics for the scatter plot, where the log scale is
+    # used if any of the branches cover more than 2 orders of magnitude
+    scatter_data = stack_columns(measurements, names, scatter_branches)
+    scatter_ymin, scatter_ymax = get_log_range(scatter_data, axis=2)
+    scatter_islog = np.any(scatter_ymax - scatter_ymin > 2, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scatter_data = np.where(scatter_islog[:, None, None], np.log10(scatter_data), scatter_data)
+    scatter_ymin, scatter_ymax = np.min(scatter_ymin, axis=1), np.max(scatter_ymax, axis=1)
+
+    statistics = {}
+    for m, name in enumerate(names):
+        statistics[name] = {
+            "branches": list(plot_branches),
+            "data": [d[~np.isnan(d)] for d in data[m]],
+            "islog": islog[m],
+            "ylim": (ymin[m], ymax[m]),
+            "quartile1": quartile1[m],
+            "medians": medians[m],
+            "quartile3": quartile3[m],
+            "whiskers_min": whiskers_min[m],
+            "whiskers_max": whiskers_max[m],
+            "scatter_branches": list(scatter_branches),
+            "scatter_data": [d[~np.isnan(d)] for d in scatter_data[m]],
+            "scatter_islog": scatter_islog[m],
+            "scatter_ylim": (scatter_ymin[m], scatter_ymax[m]),
+        }
+    return statistics
 
 
 class Metric:
@@ -101,6 +337,35 @@ class Metric:
         self.name = name
         self.units = units
 
+    def get_branches(
+            self,
+            measurements: Dict[str, np.rec.recarray],
+            plot_indices: Sequence = None,
+            scatter_indices: Sequence = None,
+    ) -> Tuple[List[str], List[str]]:
+        """Select the branches that are plotted for this metric
+
+        :param measurements: Dictionary (branch name, measurments)
+            of measurements for each branch.
+        :param plot_indices: The indices or slice of the branches that
+            contain this metric to use in the box and violin plots.
+            If `plot_indices` is `None` then only the 10 latest branches are used.
+        :param scatter_indices: The indices or slice of the branches that
+            contain this metric to use in the scatter plot. Only branches that
+            have not been compacted have measurements for each source,
+            so compacted branches are never in the scatter plot.
+            If `scatter_indices` is `None` then only the last two branches are plotted.
+        :return: The branches for the box and violin plots and the
+            branches for the scatter plot.
+        """
+        if plot_indices is None:
+            plot_indices = slice(-10, None)
+        if scatter_indices is None:
+            scatter_indices = slice(-2, None)
+        branches = [branch for branch, records in measurements.items() if has_column(records, self.name)]
+        full_branches = [branch for branch in branches if not getattr(measurements[branch], "compacted", False)]
+        return branches[plot_indices], full_branches[scatter_indices]
+
     def plot(
             self,
             set_id: str,
@@ -112,7 +377,8 @@ class Metric:
 
         :param set_id: ID of the set to analyze
         :param measurements: Dictionary (branch name, measurments)
-            of measurements for each branch.
+            of measurements for each branch. If `measurements` is `None`
+            then the measurements are loaded with `load_measurements`.
         :param plot_indices: The indices or slice of `measurements`
             to plot. If `plot_indices` is `None` then only the
             10 latest branches are used.
@@ -120,87 +386,247 @@ class Metric:
             to include in the scatter plot. If `scatter_indices` is `None`
             then only the last two branches are plotted.
         """
-        if measurements is None:
-            branches = get_branches()
-            measurements = {
-                branch: np.load(os.path.join(__DATA_PATH__, set_id, get_filename(branch)))["records"]
-                for branch in branches
-            }
-        if plot_indices is None:
-            plot_indices = slice(-10, None)
-        if scatter_indices is None:
-            scatter_indices = slice(-2, None)
+        return plot_all(set_id, [self], measurements, plot_indices, scatter_indices)
 
+    def draw(self, ax: Sequence[plt.axis], statistics: Dict) -> None:
+        """Draw the box, violin and scatter plots for this metric
+
+        :param ax: The three axes to draw the box, violin and scatter plots.
+        :param statistics: The statistics for this metric calculated by `get_statistics`.
+        """
         # First display the scatter plots
-        fig, ax = plt.subplots(1, 3, figsize=(15, 5))
-        records = {m: measurements[m] for m in list(measurements.keys())[scatter_indices]}
-        num_prs = len(records)
-
-        # Check to see if we need to plot a log axis
-        islog = False
-        for rec, (branch, record) in enumerate(records.items()):
-            islog |= check_log(record[self.name], ax[2])
-
-        # Display the scatter plot for each PR
-        for rec, (pr, record) in enumerate(records.items()):
-            x = np.arange(len(record[self.name]))
-            if islog:
-                data = np.log10(record[self.name])
-            else:
-                data = record[self.name]
+        if statistics["scatter_islog"]:
+            set_log_ticks(ax[2], *statistics["scatter_ylim"])
+        num_prs = len(statistics["scatter_branches"])
+        for rec, (pr, data) in enumerate(zip(statistics["scatter_branches"], statistics["scatter_data"])):
+            x = np.arange(len(data))
             ax[2].scatter(x, data, label=pr, s=10 * (num_prs - rec))
         ax[2].legend()
         ax[2].set_xlabel("blend index")
 
         # Next create the violin and box plots
-        records = {m: measurements[m] for m in list(measurements.keys())[plot_indices]}
-
+        data = statistics["data"]
+        x = np.arange(len(data))
         for ax_n, plot_type in enumerate(["box", "violin"]):
-            # Extract the data
-            x = np.arange(len(records))
-            data = []
-            for s, (pr, record) in enumerate(records.items()):
-                data.append(record[self.name])
-
-            # Check if we need a log plot
-            islog = check_log(data, ax[ax_n])
-            if islog:
-                data = [np.log10(d) for d in data]
+            if statistics["islog"]:
+                set_log_ticks(ax[ax_n], *statistics["ylim"])
 
             if plot_type == "violin":
                 # Make the violin plot
                 ax[ax_n].violinplot(data, x, showmeans=False, showextrema=False, showmedians=False)
-
-                # Calculate the quartile whiskers
-                quartile1, medians, quartile3 = np.percentile(data, [25, 50, 75], axis=1)
-                whiskers = np.array([
-                    adjacent_values(sorted_array, q1, q3)
-                    for sorted_array, q1, q3 in zip(data, quartile1, quartile3)])
-                whiskers_min, whiskers_max = whiskers[:, 0], whiskers[:, 1]
                 # Display the whiskers
-                ax[ax_n].scatter(x, medians, marker='o', color='white', s=30, zorder=3)
-                ax[ax_n].vlines(x, quartile1, quartile3, color='k', linestyle='-', lw=5)
-                ax[ax_n].vlines(x, whiskers_min, whiskers_max, color='k', linestyle='-', lw=1)
+                ax[ax_n].scatter(x, statistics["medians"], marker='o', color='white', s=30, zorder=3)
+                ax[ax_n].vlines(x, statistics["quartile1"], statistics["quartile3"], color='k', linestyle='-', lw=5)
+                ax[ax_n].vlines(
+                    x, statistics["whiskers_min"], statistics["whiskers_max"], color='k', linestyle='-', lw=1)
             else:
                 # Make the box plot
                 ax[ax_n].boxplot(data)
 
-        x_labels = tuple(records.keys())
+        x_labels = tuple(statistics["branches"])
         ax[1].xaxis.set_ticks(np.arange(len(x_labels)))
         ax[0].set_xticklabels(x_labels, size='small', rotation='vertical')
         ax[1].set_xticklabels(x_labels, size='small', rotation='vertical')
 
         ax[0].set_ylabel(self.units)
-        fig.suptitle(self.name, y=.95)
-        plt.tight_layout()
 
-        return fig
+
+def plot_all(
+        set_id: str,
+        metrics: Union[Dict[str, Metric], Sequence[Metric]] = None,
+        measurements: Dict[str, np.rec.recarray] = None,
+        plot_indices: Sequence = None,
+        scatter_indices: Sequence = None,
+        filename: str = None,
+) -> plt.Figure:
+    """Plot multiple metrics in a single figure
+
+    The statistics for all of the metrics are calculated at the same time
+    (see `get_statistics`) and each metric is drawn in its own row of the figure.
+
+    :param set_id: ID of the set to analyze
+    :param metrics: The metrics to plot. If `metrics` is `None` then
+        `all_metrics` are plotted.
+    :param measurements: Dictionary (branch name, measurments)
+        of measurements for each branch. If `measurements` is `None`
+        then the measurements are loaded with `load_measurements`.
+    :param plot_indices: The indices or slice of `measurements`
+        to plot. If `plot_indices` is `None` then only the
+        10 latest branches are used.
+    :param scatter_indices: The indices or slice of `measurements`
+        to include in the scatter plot. If `scatter_indices` is `None`
+        then only the last two branches are plotted.
+    :param filename: If `filename` is not `None` then the figure is rendered
+        with the non-interactive Agg backend, without using `pyplot`,
+        and saved to `filename`.
+    :return: The figure.
+    """
+    if metrics is None:
+        metrics = all_metrics
+    if isinstance(metrics, dict):
+        metrics = list(metrics.values())
+    if measurements is None:
+        measurements = load_measurements(set_id)
+    # Skip metrics that have not been measured for any of the branches
+    metrics = [
+        metric for metric in metrics
+        if any(has_column(records, metric.name) for records in measurements.values())
+    ]
+    if len(metrics) == 0:
+        raise ValueError("None of the metrics have been measured for {}".format(set_id))
+
+    # Metrics that are plotted with the same branches
+    # have their statistics calculated together
+    groups = OrderedDict()
+    for metric in metrics:
+        plot_branches, scatter_branches = metric.get_branches(measurements, plot_indices, scatter_indices)
+        key = (tuple(plot_branches), tuple(scatter_branches))
+        groups.setdefault(key, []).append(metric.name)
+    statistics = {}
+    for (plot_branches, scatter_branches), names in groups.items():
+        statistics.update(get_statistics(measurements, names, plot_branches, scatter_branches))
+
+    figsize = (15, 5 * len(metrics))
+    if filename is None:
+        fig, ax = plt.subplots(len(metrics), 3, figsize=figsize, squeeze=False)
+    else:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        ax = fig.subplots(len(metrics), 3, squeeze=False)
+
+    for row, metric in enumerate(metrics):
+        metric.draw(ax[row], statistics[metric.name])
+        if len(metrics) == 1:
+            fig.suptitle(metric.name, y=.95)
+        else:
+            ax[row, 1].set_title(metric.name)
+    fig.tight_layout()
+
+    if filename is not None:
+        fig.savefig(filename)
+    return fig
+
+
+def get_plot_hash(
+        metric: Metric,
+        measurements: Dict[str, np.rec.recarray],
+        plot_indices: Sequence = None,
+        scatter_indices: Sequence = None,
+) -> str:
+    """Hash everything that affects the plot of a metric
+
+    :param metric: The metric being plotted.
+    :param measurements: Dictionary (branch name, measurments)
+        of measurements for each branch.
+    :param plot_indices: The indices or slice of the branches in the box
+        and violin plots (see `Metric.get_branches`).
+    :param scatter_indices: The indices or slice of the branches in the
+        scatter plot (see `Metric.get_branches`).
+    :return: The hex digest of the `PLOT_VERSION`, the matplotlib version, the metric,
+        the branches that are plotted and the contents of the metric column
+        for each of those branches.
+    """
+    plot_branches, scatter_branches = metric.get_branches(measurements, plot_indices, scatter_indices)
+    key = hashlib.sha1()
+    key.update(json.dumps([
+        PLOT_VERSION, matplotlib.__version__, metric.name, metric.units, plot_branches, scatter_branches
+    ]).encode("utf-8"))
+    for branch in OrderedDict.fromkeys(plot_branches + scatter_branches):
+        key.update(np.ascontiguousarray(measurements[branch][metric.name]).tobytes())
+    return key.hexdigest()
+
+
+def render_plots(
+        set_id: str,
+        path: str,
+        metrics: Union[Dict[str, Metric], Sequence[Metric]] = None,
+        measurements: Dict[str, np.rec.recarray] = None,
+        plot_indices: Sequence = None,
+        scatter_indices: Sequence = None,
+        image_path: str = None,
+) -> List[str]:
+    """Render a PNG for each metric, skipping plots that have not changed
+
+    A manifest in `path` stores the `get_plot_hash` of every rendered plot, so
+    only the metrics whose records (or plotted branches) have changed since
+    the last build are plotted again. A `metrics.inc` file that displays all of
+    the plots is also written to `path`, so it can be included in the docs.
+
+    :param set_id: ID of the set to plot
+    :param path: The directory to save the plots.
+    :param metrics: The metrics to plot. If `metrics` is `None` then
+        `all_metrics` are plotted.
+    :param measurements: Dictionary (branch name, measurments)
+        of measurements for each branch. If `measurements` is `None`
+        then the measurements are loaded with `load_measurements`.
+    :param plot_indices: The indices or slice of `measurements`
+        to plot (see `Metric.plot`).
+    :param scatter_indices: The indices or slice of `measurements`
+        to include in the scatter plot (see `Metric.plot`).
+    :param image_path: The path to the plots used in `metrics.inc`. Images in
+        included files are relative to the document that includes them, so this is
+        usually the absolute path of `path` in the docs (for example "/plots/set1").
+        If `image_path` is `None` then `path` is used.
+    :return: The filenames of the plots that were rendered.
+    """
+    if metrics is None:
+        metrics = all_metrics
+    if isinstance(metrics, dict):
+        metrics = list(metrics.values())
+    if measurements is None:
+        measurements = load_measurements(set_id)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    manifest_filename = os.path.join(path, "manifest.json")
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename, "r") as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+
+    rendered = []
+    images = []
+    for metric in metrics:
+        if not any(has_column(records, metric.name) for records in measurements.values()):
+            continue
+        filename = os.path.join(path, "{}.png".format(re.sub(r"[^A-Za-z0-9]+", "_", metric.name).strip("_")))
+        images.append(filename)
+        key = get_plot_hash(metric, measurements, plot_indices, scatter_indices)
+        if manifest.get(metric.name) == key and os.path.exists(filename):
+            continue
+        plot_all(set_id, [metric], measurements, plot_indices, scatter_indices, filename=filename)
+        manifest[metric.name] = key
+        rendered.append(filename)
+        # Update the manifest after each plot so that an interrupted build is not lost
+        with open(manifest_filename, "w") as f:
+            json.dump(manifest, f)
+
+    if image_path is None:
+        image_path = path
+    include = "".join([
+        ".. image:: {}/{}\n\n".format(image_path, os.path.basename(filename))
+        for filename in images
+    ])
+    include_filename = os.path.join(path, "metrics.inc")
+    old_include = None
+    if os.path.exists(include_filename):
+        with open(include_filename) as f:
+            old_include = f.read()
+    if old_include != include:
+        with open(include_filename, "w") as f:
+            f.write(include)
+    return rendered
 
 
 # All of the metrics that are stored and plotted for regression testing
 all_metrics = {
     "init time": Metric("init time", "time (ms)"),
     "runtime": Metric("runtime", "time/source (ms)"),
+    "peak memory (MB)": Metric("peak memory (MB)", "memory (MB)"),
+    "peak RSS (MB)": Metric("peak RSS (MB)", "memory (MB)"),
     "iterations": Metric("iterations", "iterations"),
     "init logL": Metric("init logL", "logL"),
     "logL": Metric("logL", "logL"),
@@ -209,4 +635,23 @@ all_metrics = {
     "i diff": Metric("i diff", "truth-model"),
     "z diff": Metric("z diff", "truth-model"),
     "y diff": Metric("y diff", "truth-model"),
+    "match time": Metric("match time", "time (ms)"),
+    "init sources time": Metric("init sources time", "time (ms)"),
+    "fit time": Metric("fit time", "time (ms)"),
+    "log norm time": Metric("log norm time", "time (ms)"),
+    "measure time": Metric("measure time", "time (ms)"),
+    "init time min": Metric("init time min", "time (ms)"),
+    "init time median": Metric("init time median", "time (ms)"),
+    "init time spread": Metric("init time spread", "time (ms)"),
+    "runtime min": Metric("runtime min", "time/source (ms)"),
+    "runtime median": Metric("runtime median", "time/source (ms)"),
+    "runtime spread": Metric("runtime spread", "time/source (ms)"),
+    "init time cpu median": Metric("init time cpu median", "time (ms)"),
+    "runtime cpu median": Metric("runtime cpu median", "time/source (ms)"),
 }
+# Every metric is stored under a separate name when the sources are warm started
+all_metrics.update({
+    get_warm_start_name(name): Metric(get_warm_start_name(name), metric.units)
+    for name, metric in list(all_metrics.items())
+})
+all_metrics["warm sources"] = Metric("warm sources", "sources")
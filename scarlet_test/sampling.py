@@ -0,0 +1,295 @@
+import os
+from collections import namedtuple, OrderedDict
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+
+from . import settings
+from .core import __BLEND_PATH__, get_blend_ids, get_blend_path, get_store, read_array_shape
+from .store import MeasurementStore
+
+
+# A stratified sample of the blends in a set:
+#   * `blend_ids`: The IDs of the selected blends, in the same order as the set.
+#   * `strata`: The stratum of each selected blend.
+#   * `stratum_sizes`: The number of blends in each stratum of the full set.
+Sample = namedtuple("Sample", ["blend_ids", "strata", "stratum_sizes"])
+
+
+def get_row_blend_ids(
+        store: MeasurementStore,
+        branch: str,
+        set_id: str = None,
+        data_path: str = None,
+) -> np.ndarray:
+    """The blend ID of each row in a branch
+
+    Branches that were migrated from the old npz files do not have blend IDs,
+    but the rows are always stored in the same order as the blends in the set,
+    with one row for each matched source. So the blend IDs can be recovered if
+    the number of rows matches the number of matched sources in the set.
+
+    :param store: The measurement store for the set.
+    :param branch: The name of the branch.
+    :param set_id: ID of the set, used to find the blends if `data_path` is `None`.
+    :param data_path: The path to the blend data. The blends are only
+        read if the blend IDs have to be recovered.
+    :return: The blend ID of each row, or `None` if it cannot be recovered.
+    """
+    row_ids = store.get_blend_ids(branch)
+    if len(row_ids) > 0 and not np.any(row_ids == ""):
+        return row_ids
+    try:
+        if data_path is None:
+            data_path = os.path.join(__BLEND_PATH__, set_id)
+            blend_ids = get_blend_ids(set_id=set_id)
+        else:
+            blend_ids = get_blend_ids(path=data_path)
+        data_path = get_blend_path(data_path)
+        matched = [
+            read_array_shape(os.path.join(data_path, "{}.npz".format(blend_id)), "matched")[0]
+            for blend_id in blend_ids
+        ]
+    except (OSError, KeyError, ValueError):
+        return None
+    if np.sum(matched) != len(row_ids):
+        return None
+    return np.repeat(np.array(blend_ids, dtype=str), matched)
+
+
+def get_blend_features(set_id: str, data_path: str = None) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """The features of each blend used to stratify the sample
+
+    The features are the time it took to deblend each blend, the number
+    of sources in the blend, and the variance of the flux differences
+    of its sources. The times and flux differences are taken from the latest
+    branch in the measurement store with the required metrics. If no
+    branch has been stored then the size of the blend is used instead.
+
+    :param set_id: ID of the set.
+    :param data_path: The path to the blend data. If `data_path` is `None`
+        then the blends for `set_id` are used.
+    :return: The IDs of the blends in the set and a dictionary
+        (feature name, value for each blend).
+    """
+    set_path = data_path
+    if data_path is None:
+        data_path = os.path.join(__BLEND_PATH__, set_id)
+        blend_ids = get_blend_ids(set_id=set_id)
+    else:
+        blend_ids = get_blend_ids(path=data_path)
+    blend_ids = np.array(blend_ids, dtype=str)
+    data_path = get_blend_path(data_path)
+    filenames = [os.path.join(data_path, "{}.npz".format(blend_id)) for blend_id in blend_ids]
+    features = OrderedDict()
+    features["sources"] = np.array([read_array_shape(filename, "centers")[0] for filename in filenames], dtype=float)
+
+    store = get_store(set_id)
+    diff_names = ["{} diff".format(f) for f in settings.filters]
+    for branch in store.branches[::-1]:
+        names = ["runtime", "init time"] + diff_names
+        if not all(store.has_column(name, branch) for name in names):
+            continue
+        row_ids = get_row_blend_ids(store, branch, set_id, set_path)
+        if row_ids is None:
+            continue
+        idx = np.searchsorted(blend_ids[np.argsort(blend_ids)], row_ids)
+        idx = np.argsort(blend_ids)[idx]
+        # `runtime` is per source, so it is summed over the sources in each blend,
+        # while `init time` is per blend (and repeated for each source), so it is only counted once
+        features["runtime"] = np.bincount(idx, weights=store.get_column("runtime", branch), minlength=len(blend_ids))
+        first = np.unique(idx, return_index=True)[1]
+        features["runtime"][idx[first]] += store.get_column("init time", branch)[first]
+        diffs = np.array([store.get_column(name, branch) for name in diff_names], dtype=float)
+        valid = ~np.isnan(diffs)
+        diffs = np.where(valid, diffs, 0)
+        count = np.bincount(idx, weights=np.sum(valid, axis=0), minlength=len(blend_ids))
+        total = np.bincount(idx, weights=np.sum(diffs, axis=0), minlength=len(blend_ids))
+        total2 = np.bincount(idx, weights=np.sum(diffs**2, axis=0), minlength=len(blend_ids))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = total2 / count - (total / count)**2
+        features["flux diff variance"] = np.where(count > 0, variance, 0)
+        return blend_ids, features
+
+    # No branch has been stored, so use the size of each blend as the cost
+    features["runtime"] = np.array([np.prod(read_array_shape(filename, "images")) for filename in filenames],
+                                   dtype=float) * features["sources"]
+    return blend_ids, features
+
+
+def select_sample(
+        blend_ids: Sequence[str],
+        features: Dict[str, np.ndarray],
+        size: int,
+        bins: int = 2,
+        seed: int = None,
+) -> Sample:
+    """Select a stratified random sample of blends
+
+    Each feature is split into `bins` quantile bins, and each combination
+    of bins is a stratum. The blends are sampled from each stratum in
+    proportion to its size, with at least one blend from every stratum,
+    so the sample may contain slightly more than `size` blends.
+
+    :param blend_ids: The IDs of the blends in the set.
+    :param features: Dictionary (feature name, value for each blend)
+        (see `get_blend_features`).
+    :param size: The number of blends to select.
+    :param bins: The number of bins for each feature.
+    :param seed: The seed of the random number generator.
+    :return: The selected blends.
+    """
+    blend_ids = np.asarray(blend_ids, dtype=str)
+    if size < 1:
+        raise ValueError("The sample must contain at least one blend, got {}".format(size))
+    strata = np.zeros(len(blend_ids), dtype=int)
+    for values in features.values():
+        edges = np.quantile(values, np.linspace(0, 1, bins + 1)[1:-1])
+        strata = strata * bins + np.searchsorted(edges, values, side="right")
+    # Relabel the strata so that only non-empty strata are used
+    _, strata = np.unique(strata, return_inverse=True)
+    stratum_sizes = np.bincount(strata)
+
+    allocation = np.minimum(stratum_sizes, np.maximum(1, np.round(size * stratum_sizes / len(blend_ids)))).astype(int)
+    rng = np.random.default_rng(seed)
+    selected = np.concatenate([
+        rng.choice(np.where(strata == h)[0], size=n, replace=False)
+        for h, n in enumerate(allocation)
+    ])
+    selected = np.sort(selected)
+    return Sample(blend_ids[selected], strata[selected], stratum_sizes)
+
+
+def get_sample(set_id: str, size: int, data_path: str = None, bins: int = 2, seed: int = None) -> Sample:
+    """Select a stratified sample of the blends in a set
+
+    :param set_id: ID of the set.
+    :param size: The number of blends to select.
+    :param data_path: The path to the blend data (see `get_blend_features`).
+    :param bins: The number of bins for each feature (see `select_sample`).
+    :param seed: The seed of the random number generator.
+    :return: The selected blends.
+    """
+    blend_ids, features = get_blend_features(set_id, data_path)
+    return select_sample(blend_ids, features, size, bins, seed)
+
+
+def weighted_median(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """The weighted median of each row of values, for each set of weights
+
+    With integer weights this is the same as `np.median` of the values
+    repeated `weights` times, without building the repeated arrays.
+
+    :param values: The values, with shape (metrics, rows).
+    :param weights: The (non-negative) weight of each row in
+        each sample, with shape (samples, rows).
+    :return: The median of each metric in each sample, with shape (metrics, samples).
+        Metrics with a `NaN` value are `NaN`.
+    """
+    half = np.sum(weights, axis=1)[:, None] / 2
+    medians = np.full((len(values), len(weights)), np.nan)
+    for m, column in enumerate(values):
+        if np.any(np.isnan(column)):
+            continue
+        order = np.argsort(column)
+        cumulative = np.cumsum(weights[:, order], axis=1)
+        # The two middle values, which are the same unless the weights are split exactly in half
+        low = np.argmax(cumulative >= half, axis=1)
+        high = np.argmax(cumulative > half, axis=1)
+        medians[m] = (column[order][low] + column[order][high]) / 2
+    return medians
+
+
+def estimate_statistics(
+        records: np.rec.recarray,
+        row_blend_ids: Sequence[str],
+        sample: Sample,
+        metrics: Sequence[str] = None,
+        samples: int = 1000,
+        confidence: float = 0.95,
+        seed: int = None,
+) -> np.rec.recarray:
+    """Estimate the statistics of the full set from a sample
+
+    The mean of each metric (over all of the sources in the set) is estimated
+    with a stratified ratio estimator and its standard error, while the
+    median is estimated from the sources weighted by the inverse of the
+    sampling fraction of their stratum, with a stratified bootstrap interval.
+
+    :param records: The measurements of the sampled blends.
+    :param row_blend_ids: The blend ID of each row in `records`.
+    :param sample: The sample used to select the blends.
+    :param metrics: The names of the metrics to estimate. If `metrics`
+        is `None` then all of the metrics in `records` are estimated.
+    :param samples: The number of bootstrap samples.
+    :param confidence: The confidence level of the bootstrap interval.
+    :param seed: The seed used for the bootstrap.
+    :return: Records with the estimate for each metric:
+
+        * `metric`: The name of the metric.
+        * `mean`, `mean error`: The estimated mean and its standard error.
+        * `median`: The estimated median.
+        * `median low`, `median high`: Bootstrap interval of the median.
+    """
+    if metrics is None:
+        metrics = list(records.dtype.names)
+    metrics = [name for name in metrics if name in records.dtype.names]
+    blend_ids = np.asarray(sample.blend_ids, dtype=str)
+    order = np.argsort(blend_ids)
+    idx = order[np.searchsorted(blend_ids[order], np.asarray(row_blend_ids, dtype=str))]
+    num_blends = len(blend_ids)
+    sampled = np.bincount(sample.strata, minlength=len(sample.stratum_sizes))
+    blend_weights = sample.stratum_sizes[sample.strata] / sampled[sample.strata]
+    row_weights = blend_weights[idx]
+    rows_per_blend = np.bincount(idx, minlength=num_blends).astype(float)
+    rng = np.random.default_rng(seed)
+    # The resampled blends for the bootstrap, drawn within each stratum
+    strata_members = [np.where(sample.strata == h)[0] for h in range(len(sample.stratum_sizes))]
+    resampled = np.concatenate([
+        members[rng.integers(0, len(members), size=(samples, len(members)))]
+        for members in strata_members if len(members) > 0
+    ], axis=1)
+
+    rows = []
+    for name in metrics:
+        values = np.asarray(records[name], dtype=float)
+        totals = np.bincount(idx, weights=values, minlength=num_blends)
+        # Stratified ratio estimator of the mean over all sources
+        total_rows = np.sum(blend_weights * rows_per_blend)
+        mean = np.sum(blend_weights * totals) / total_rows
+        residuals = (totals - mean * rows_per_blend) / (total_rows / np.sum(sample.stratum_sizes))
+        # Strata with a single sampled blend use the variance of the whole sample ("collapsed strata")
+        pooled_variance = np.var(residuals, ddof=1) if num_blends > 1 else 0
+        variance = 0
+        for h, members in enumerate(strata_members):
+            n, size = len(members), sample.stratum_sizes[h]
+            stratum_variance = np.var(residuals[members], ddof=1) if n > 1 else pooled_variance
+            variance += size**2 * (1 - n / size) * stratum_variance / n
+        mean_error = np.sqrt(variance) / np.sum(sample.stratum_sizes)
+
+        median = weighted_median(values[None], row_weights[None])[0, 0]
+        counts = np.array([np.bincount(blend_sample, minlength=num_blends) for blend_sample in resampled])
+        weights = row_weights * counts[:, idx]
+        weights = weights[np.sum(weights, axis=1) > 0]
+        medians = weighted_median(values[None], weights)[0]
+        alpha = (1 - confidence) / 2
+        low, high = np.percentile(medians, [100 * alpha, 100 * (1 - alpha)])
+        rows.append((name, mean, mean_error, median, low, high))
+    return np.rec.fromrecords(rows, names=["metric", "mean", "mean error", "median", "median low", "median high"])
+
+
+def format_estimates(estimates: np.rec.recarray) -> str:
+    """Format the result of `estimate_statistics` as a table
+
+    :param estimates: The estimated statistics.
+    :return: The formatted table.
+    """
+    header = "{:<20} {:>24} {:>32}".format("metric", "mean", "median")
+    lines = [header, "-" * len(header)]
+    for row in estimates:
+        lines.append("{:<20} {:>24} {:>32}".format(
+            row["metric"],
+            "{:.4g} +/- {:.2g}".format(row["mean"], row["mean error"]),
+            "{:.4g} [{:.4g}, {:.4g}]".format(row["median"], row["median low"], row["median high"]),
+        ))
+    return "\n".join(lines)
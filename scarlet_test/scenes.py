@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+
+# The arrays rendered for each scene
+SCENE_KEYS = ("images", "model", "residual", "mask", "centers")
+
+
+def get_scene(observation, sources: Sequence) -> Dict[str, np.ndarray]:
+    """Render the arrays displayed in the residual scene of a blend
+
+    This is the same model and residual that `scarlet.display.show_scene`
+    displays, but only the arrays are kept, so that the scene can be
+    plotted later (and in another process) without the sources.
+
+    :param observation: The observation used for deblending.
+    :param sources: The deblended sources. Sources that were skipped are `None`.
+    :return: Dictionary with the observed `images`, the `model` rendered
+        in the observation frame, the `residual`, the `mask` of pixels with
+        no weight in any band, and the (y, x) `centers` used to label each source
+        (`NaN` for skipped sources, so that the labels match the source indices).
+    """
+    centers = np.full((len(sources), 2), np.nan)
+    for k, src in enumerate(sources):
+        if src is not None and hasattr(src, "center"):
+            centers[k] = np.asarray(src.center, dtype=float)[-2:]
+    sources = [src for src in sources if src is not None]
+    model = np.sum([src.get_model(frame=src.frame) for src in sources], axis=0)
+    model = observation.render(model)
+    images = np.asarray(observation.images)
+    weights = np.asarray(observation.weights)
+    return {
+        "images": images,
+        "model": np.asarray(model),
+        "residual": images - model,
+        "mask": np.all(weights == 0, axis=0) if weights.ndim == 3 else np.zeros(images.shape[-2:], dtype=bool),
+        "centers": centers,
+    }
+
+
+def get_scene_hash(scene: Dict[str, np.ndarray]) -> str:
+    """Hash the contents of a scene
+
+    The title is the branch name, so it is not included,
+    otherwise every new branch would re-render every scene.
+
+    :param scene: The scene arrays (see `get_scene`).
+    :return: The hex digest of the scene arrays.
+    """
+    key = hashlib.sha1()
+    for name in SCENE_KEYS:
+        data = np.ascontiguousarray(scene[name])
+        key.update(json.dumps([name, data.dtype.str, data.shape]).encode("utf-8"))
+        key.update(data.tobytes())
+    return key.hexdigest()
+
+
+def plot_scene(scene: Dict[str, np.ndarray], title: str = None, fig=None):
+    """Plot the observation, rendered model and residual of a blend
+
+    This is the same figure drawn by `scarlet.display.show_scene`, with the
+    pixels without any weight masked and each source labeled with its index.
+
+    :param scene: The scene arrays (see `get_scene`).
+    :param title: The title of the figure.
+    :param fig: The figure to draw the scene in. If `fig` is `None` then
+        a new figure is created with the non-interactive Agg backend,
+        without using `pyplot`, so that it is safe to use in worker processes.
+    :return: The figure.
+    """
+    from scarlet.display import AsinhMapping, LinearPercentileNorm, img_to_rgb
+
+    if fig is None:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(15, 5))
+        FigureCanvasAgg(fig)
+    images = scene["images"]
+    mask = scene["mask"]
+    norm = AsinhMapping(minimum=np.min(images), stretch=np.max(images) * 0.055, Q=10)
+    panels = [
+        ("Observation", img_to_rgb(images, norm=norm, mask=mask)),
+        ("Model Rendered", img_to_rgb(scene["model"], norm=norm, mask=mask)),
+        ("Residual", img_to_rgb(scene["residual"], norm=LinearPercentileNorm(scene["residual"]), mask=mask)),
+    ]
+    axes = fig.subplots(1, len(panels))
+    for ax, (label, rgb) in zip(axes, panels):
+        ax.imshow(rgb)
+        ax.set_title(label)
+        for k, (y, x) in enumerate(scene["centers"]):
+            if np.isfinite(y):
+                ax.text(x, y, k, color="w", ha="center", va="center")
+    if title is not None:
+        fig.suptitle(title, y=1.05)
+    return fig
+
+
+def save_scene(filename: str, scene: Dict[str, np.ndarray], title: str = None) -> str:
+    """Save the residual scene of a blend
+
+    If `filename` already exists it is moved to "old_<filename>"
+    first, so that the previous version can be compared with the new one.
+
+    :param filename: The name of the PNG file.
+    :param scene: The scene arrays (see `get_scene`).
+    :param title: The title of the figure.
+    :return: `filename`
+    """
+    fig = plot_scene(scene, title)
+    if os.path.exists(filename):
+        # Copy the current version as the old filename
+        path, basename = os.path.split(filename)
+        shutil.move(filename, os.path.join(path, "old_{}".format(basename)))
+    fig.savefig(filename)
+    return filename
+
+
+class SceneWriter:
+    """Save the residual scenes of a set in a separate pipeline stage
+
+    The scenes are rendered by a pool of worker processes while the
+    blends are still being deblended, so plotting the residuals does not
+    hold up the fit. A manifest in `path` stores the `get_scene_hash` of
+    every saved scene, and scenes whose arrays have not changed since they
+    were saved are skipped, so neither the PNG nor its `old_*` copy is rewritten.
+    """
+    manifest_file = "scenes.json"
+
+    def __init__(self, path: str, workers: int = None, executor: Executor = None):
+        """Initialize the class
+
+        :param path: The directory to save the scenes.
+        :param workers: The number of processes used to render the scenes.
+            If `workers` is `None` (or `1`) and no `executor` is given then
+            the scenes are rendered in the current process.
+        :param executor: An existing `concurrent.futures.Executor` used to render
+            the scenes. This takes precedence over `workers` and is not shut down by `close`.
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._shutdown = False
+        if executor is None and workers is not None and workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            self._shutdown = True
+        self.executor = executor
+        self.manifest = self.load_manifest()
+        self._pending = {}
+        self.saved = []
+        self.skipped = []
+
+    @property
+    def manifest_filename(self) -> str:
+        """The full path to the manifest"""
+        return os.path.join(self.path, self.manifest_file)
+
+    def load_manifest(self) -> Dict[str, str]:
+        """Load the hash of each saved scene
+
+        :return: Dictionary (blend ID, hash) of the saved scenes.
+        """
+        if not os.path.exists(self.manifest_filename):
+            return {}
+        with open(self.manifest_filename, "r") as f:
+            return json.load(f)
+
+    def get_filename(self, blend_id: str) -> str:
+        """The name of the file used to save a scene
+
+        :param blend_id: The ID of the blend.
+        :return: The full path to the PNG for the blend.
+        """
+        return os.path.join(self.path, "{}.scene.png".format(blend_id))
+
+    def submit(self, blend_id: str, scene: Dict[str, np.ndarray], title: str = None) -> None:
+        """Save the scene for a blend, unless it has not changed
+
+        Only the scene arrays are compared, so a scene is not
+        saved again just because the title (branch) has changed.
+
+        :param blend_id: The ID of the blend.
+        :param scene: The scene arrays (see `get_scene`).
+        :param title: The title of the figure.
+        """
+        blend_id = str(blend_id)
+        key = get_scene_hash(scene)
+        filename = self.get_filename(blend_id)
+        if self.manifest.get(blend_id) == key and os.path.exists(filename):
+            self.skipped.append(blend_id)
+            return
+        if self.executor is None:
+            save_scene(filename, scene, title)
+            self._finish(blend_id, key)
+        else:
+            self._pending[blend_id] = (key, self.executor.submit(save_scene, filename, scene, title))
+
+    def _finish(self, blend_id: str, key: str) -> None:
+        """Record that a scene has been saved
+
+        :param blend_id: The ID of the blend.
+        :param key: The hash of the scene.
+        """
+        self.manifest[blend_id] = key
+        self.saved.append(blend_id)
+
+    def close(self, cancel: bool = False) -> List[str]:
+        """Wait for all of the scenes to be saved and update the manifest
+
+        :param cancel: Whether or not to cancel the scenes that have not
+            started rendering (for example if the run was stopped by an error).
+        :return: The IDs of the blends whose scenes were saved.
+        """
+        if cancel:
+            for key, future in self._pending.values():
+                future.cancel()
+        try:
+            for blend_id, (key, future) in self._pending.items():
+                if future.cancelled():
+                    continue
+                future.result()
+                self._finish(blend_id, key)
+        finally:
+            # If a scene failed the remaining scenes are cancelled, so that shutting down does not wait for them
+            for key, future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+            if self._shutdown:
+                self.executor.shutdown()
+            tmp_filename = self.manifest_filename + ".tmp"
+            with open(tmp_filename, "w") as f:
+                json.dump(self.manifest, f)
+            os.replace(tmp_filename, self.manifest_filename)
+        return self.saved
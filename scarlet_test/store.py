@@ -0,0 +1,572 @@
+import json
+import os
+import shutil
+from collections.abc import Mapping
+from typing import List, Dict, Sequence, Iterator, Tuple
+
+import numpy as np
+
+
+# The number of rows preallocated for each blend when the records for a set are assembled
+# (see `RecordBuilder`). Most blends have fewer sources, so the records for a set are usually
+# allocated only once, and the array still grows (by doubling) if a set has more.
+ROWS_PER_BLEND = 8
+# The quantiles stored for each metric of a compacted branch. These include the
+# minimum and maximum, and are dense enough to be used as a sample of the metric.
+SUMMARY_QUANTILES = np.linspace(0, 1, 101)
+
+
+def summarize_column(data: np.ndarray) -> Tuple[np.ndarray, float, int]:
+    """Summarize a single column of a branch
+
+    :param data: The column.
+    :return: The `SUMMARY_QUANTILES` of the column, its mean and the
+        number of (non `NaN`) rows in the column.
+    """
+    data = np.asarray(data, dtype=float)
+    data = data[~np.isnan(data)]
+    if len(data) == 0:
+        return np.full(len(SUMMARY_QUANTILES), np.nan), np.nan, 0
+    return np.quantile(data, SUMMARY_QUANTILES), np.mean(data), len(data)
+
+
+class BranchRecords(Mapping):
+    """Read-only view of the records for a single branch
+
+    This behaves like the `records` for the branch, except that
+    each column is only loaded (memory mapped) when it is accessed.
+    """
+    def __init__(self, store: "MeasurementStore", branch: str):
+        """Initialize the class
+
+        :param store: The store containing the branch.
+        :param branch: The name of the branch.
+        """
+        self.store = store
+        self.branch = branch
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if not self.store.has_column(name, self.branch):
+            raise KeyError(name)
+        return self.store.get_column(name, self.branch)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([name for name in self.store.columns if self.store.has_column(name, self.branch)])
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+
+class BranchSummary(Mapping):
+    """Read-only view of the summary of a compacted branch
+
+    This behaves like `BranchRecords`, except that each column is the
+    `SUMMARY_QUANTILES` of the metric instead of the measurement for each source.
+    The quantiles are an evenly weighted sample of the metric, so the quartiles,
+    median and range of a compacted branch are the same as the full branch,
+    and it can be plotted like any other branch (except in a scatter plot).
+    """
+    compacted = True
+
+    def __init__(self, store: "MeasurementStore", branch: str):
+        """Initialize the class
+
+        :param store: The store containing the branch.
+        :param branch: The name of the branch.
+        """
+        self.store = store
+        self.branch = branch
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.store.get_summary(name, self.branch, "quantiles")
+
+    def __contains__(self, name: str) -> bool:
+        # Use the index, so that checking for a metric does not load its summary
+        return self.branch in self.store.index["summaries"]["columns"].get(name, [])
+
+    def __iter__(self) -> Iterator[str]:
+        columns = self.store.index["summaries"]["columns"]
+        return iter([name for name, branches in columns.items() if self.branch in branches])
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+    def mean(self, name: str) -> float:
+        """The mean of a metric in the full branch"""
+        return float(self.store.get_summary(name, self.branch, "mean"))
+
+    def count(self, name: str) -> int:
+        """The number of sources measured in the full branch"""
+        return int(self.store.get_summary(name, self.branch, "count"))
+
+
+class MeasurementStore:
+    """Columnar store of the measurement records for every branch in a set
+
+    The records of each branch are saved in their own segment, a directory
+    with a single uncompressed `.npy` file for each column (metric), so that
+    a single column for a single branch can be read as a zero-copy view of
+    a memory mapped array. The `blend_id` column of each segment contains
+    the ID of the blend that each row (source) belongs to.
+    An `index.json` file keeps track of the segment and columns of each branch.
+    Segments are never modified once they are written: adding a branch
+    writes a new segment and then replaces the index, so replacing the index
+    is the only step that changes the store and a write that is interrupted
+    leaves the previous version of the store intact.
+    """
+    index_file = "index.json"
+    blend_column = "blend_id"
+    segment_prefix = "segment_"
+
+    def __init__(self, path: str):
+        """Initialize the class
+
+        :param path: The directory containing the store.
+        """
+        self.path = path
+        self._columns = {}
+        self._summaries = None
+        self.index = self.load_index()
+
+    @property
+    def index_filename(self) -> str:
+        """The full path to the index file"""
+        return os.path.join(self.path, self.index_file)
+
+    def load_index(self) -> Dict:
+        """Load the index of the store
+
+        :return: The index, or an empty index if the store
+            has not been created yet.
+        """
+        if not os.path.exists(self.index_filename):
+            index = {"branches": [], "segments": {}, "columns": {}}
+        else:
+            with open(self.index_filename, "r") as f:
+                index = json.load(f)
+        index.setdefault("summaries", {"branches": [], "columns": {}})
+        return index
+
+    @property
+    def branches(self) -> List[str]:
+        """The branches in the store"""
+        return self.index["branches"]
+
+    @property
+    def compacted_branches(self) -> List[str]:
+        """The branches that have been compacted into summaries (see `compact`)"""
+        return self.index["summaries"]["branches"]
+
+    @property
+    def columns(self) -> List[str]:
+        """The names of all of the measurement columns in the store"""
+        return list(self.index["columns"].keys())
+
+    def has_column(self, name: str, branch: str) -> bool:
+        """Check whether or not a branch contains a given column
+
+        :param name: The name of the column.
+        :param branch: The name of the branch.
+        :return: `True` if `branch` has measurements for the column `name`.
+        """
+        return name in self.index["columns"] and branch in self.index["columns"][name]["branches"]
+
+    @staticmethod
+    def get_column_filename(name: str) -> str:
+        """Consistently set the filename for each column
+
+        :param name: The name of the column.
+        :return: The name of the file containing the column.
+        """
+        return "{}.npy".format(name.replace(" ", "_"))
+
+    def column(self, name: str, branch: str) -> np.ndarray:
+        """Load a column for a branch, without checking that the branch has the column
+
+        :param name: The name of the column.
+        :param branch: The name of the branch.
+        :return: Read-only memory mapped array with the column for `branch`.
+        """
+        key = (name, branch)
+        if key not in self._columns:
+            filename = os.path.join(self.path, self.index["segments"][branch], self.get_column_filename(name))
+            self._columns[key] = np.load(filename, mmap_mode="r")
+        return self._columns[key]
+
+    def get_column(self, name: str, branch: str) -> np.ndarray:
+        """Load a single column for a single branch
+
+        :param name: The name of the column.
+        :param branch: The name of the branch.
+        :return: Read-only view of the column for `branch`.
+        """
+        if not self.has_column(name, branch):
+            msg = "Branch {} does not have any measurements for {}"
+            raise ValueError(msg.format(branch, name))
+        return self.column(name, branch)
+
+    def get_blend_ids(self, branch: str) -> np.ndarray:
+        """The blend ID for each row in a branch
+
+        :param branch: The name of the branch.
+        :return: The blend ID of each source in `branch`.
+            Branches that were migrated from the old npz files
+            do not have blend IDs, so an empty string is used instead.
+        """
+        return self.column(self.blend_column, branch)
+
+    def get_branch(self, branch: str) -> Mapping:
+        """Get a read-only view of the records for a branch
+
+        :param branch: The name of the branch.
+        :return: A view that loads the columns of `branch` as they are needed,
+            or the `BranchSummary` of `branch` if it has been compacted.
+        """
+        if branch in self.compacted_branches and branch not in self.branches:
+            return BranchSummary(self, branch)
+        return BranchRecords(self, branch)
+
+    @property
+    def summary_filename(self) -> str:
+        """The full path to the file with the summaries of the compacted branches"""
+        return os.path.join(self.path, self.index["summaries"]["file"])
+
+    def get_summary(self, name: str, branch: str, statistic: str) -> np.ndarray:
+        """Load a summary statistic of a compacted branch
+
+        :param name: The name of the column.
+        :param branch: The name of the compacted branch.
+        :param statistic: The statistic to load ("quantiles", "mean" or "count").
+        :return: The statistic of the column in `branch`.
+        """
+        branches = self.index["summaries"]["columns"].get(name, [])
+        if branch not in branches:
+            raise KeyError(name)
+        if self._summaries is None:
+            # The summaries are small, so they are all loaded (once) the first time they are used
+            with np.load(self.summary_filename) as data:
+                self._summaries = {key: data[key] for key in data.keys()}
+        return self._summaries["{}/{}".format(name, statistic)][branches.index(branch)]
+
+    def compact(self, branches: Sequence[str]) -> None:
+        """Replace the records of branches with summaries
+
+        The `SUMMARY_QUANTILES`, mean and count of every column are stored
+        for each branch, and the records for the branch are removed from
+        the store, so the size of the store does not grow with old branches.
+
+        :param branches: The branches to compact.
+        """
+        branches = [branch for branch in branches if branch in self.branches]
+        if len(branches) == 0:
+            return
+        summaries = json.loads(json.dumps(self.index["summaries"]))
+        arrays = {}
+        if len(summaries["branches"]) > 0:
+            with np.load(self.summary_filename) as data:
+                arrays = {key: data[key] for key in data.keys()}
+        for branch in branches:
+            # Replace the old summary if the branch was compacted before
+            for name, column_branches in summaries["columns"].items():
+                if branch in column_branches:
+                    row = column_branches.index(branch)
+                    for statistic in ["quantiles", "mean", "count"]:
+                        key = "{}/{}".format(name, statistic)
+                        arrays[key] = np.delete(arrays[key], row, axis=0)
+                    column_branches.remove(branch)
+            if branch in summaries["branches"]:
+                summaries["branches"].remove(branch)
+            for name in self.columns:
+                if not self.has_column(name, branch):
+                    continue
+                quantiles, mean, count = summarize_column(self.get_column(name, branch))
+                for statistic, value in [("quantiles", quantiles), ("mean", mean), ("count", count)]:
+                    key = "{}/{}".format(name, statistic)
+                    value = np.asarray(value)[None]
+                    arrays[key] = value if key not in arrays else np.concatenate([arrays[key], value])
+                summaries["columns"].setdefault(name, []).append(branch)
+            summaries["branches"].append(branch)
+
+        # The summaries are written to a new file, which is only used once the index is replaced
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        file_id = self.index.get("next_id", 0)
+        summaries["file"] = "summaries_{}.npz".format(file_id)
+        np.savez(os.path.join(self.path, summaries["file"]), **arrays)
+        self.add_branches({}, remove=branches, summaries=summaries, next_id=file_id + 1)
+
+    def get_records(self, branch: str) -> np.rec.recarray:
+        """Load all of the columns for a branch
+
+        :param branch: The name of the branch.
+        :return: The measurement `records` for `branch`.
+        """
+        names = [name for name in self.columns if self.has_column(name, branch)]
+        return np.rec.fromarrays([self.get_column(name, branch) for name in names], names=names)
+
+    def add_branch(
+            self,
+            branch: str,
+            records: np.rec.recarray,
+            blend_ids: Sequence[str] = None,
+            timeouts: Sequence[str] = None,
+    ) -> None:
+        """Add (or replace) the records for a single branch
+
+        :param branch: The name of the branch.
+        :param records: The measurement records for the branch.
+        :param blend_ids: The blend ID for each record.
+        :param timeouts: The IDs of the blends that timed out.
+        """
+        blend_ids = None if blend_ids is None else {branch: blend_ids}
+        timeouts = None if timeouts is None else {branch: timeouts}
+        self.add_branches({branch: records}, blend_ids, timeouts)
+
+    def get_timeouts(self, branch: str) -> List[str]:
+        """The IDs of the blends that timed out in a branch
+
+        :param branch: The name of the branch.
+        :return: The IDs of the blends that timed out.
+        """
+        return self.index.get("timeouts", {}).get(branch, [])
+
+    def add_branches(
+            self,
+            records: Dict[str, np.rec.recarray],
+            blend_ids: Dict[str, Sequence[str]] = None,
+            timeouts: Dict[str, Sequence[str]] = None,
+            remove: Sequence[str] = (),
+            summaries: Dict = None,
+            next_id: int = None,
+    ) -> None:
+        """Add (or replace) the records for multiple branches
+
+        A new segment is written for each branch in `records`, and the
+        segments of the other branches are left untouched, so the cost of
+        adding a branch does not depend on the size of the store.
+        All of the changes are applied at the same time, when the index is
+        replaced, and the segments that are no longer used are removed afterwards.
+
+        :param records: Dictionary (branch name, records) of the
+            measurements for each branch.
+        :param blend_ids: Dictionary (branch name, blend IDs) of the blend ID for
+            each record in each branch. If `blend_ids` is `None`, or a branch is
+            missing, then the blend IDs for the branch are not known.
+        :param timeouts: Dictionary (branch name, blend IDs) of the blends
+            that timed out in each branch.
+        :param remove: The branches to remove from the store.
+        :param summaries: The new summaries of the compacted branches
+            (see `compact`). If `summaries` is `None` then the summaries
+            are unchanged.
+        :param next_id: The ID of the next file written to the store,
+            if a file was already written for this update.
+        """
+        if blend_ids is None:
+            blend_ids = {}
+        if timeouts is None:
+            timeouts = {}
+        if summaries is None:
+            summaries = self.index["summaries"]
+        if next_id is None:
+            next_id = self.index.get("next_id", 0)
+        old_branches = [branch for branch in self.branches if branch not in records and branch not in remove]
+        branches = old_branches + list(records.keys())
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # The segments of the old branches are unchanged
+        segments = {branch: self.index["segments"][branch] for branch in old_branches}
+
+        # Write a new segment for each new branch
+        for branch, record in records.items():
+            if branch in blend_ids:
+                ids = np.array([str(blend_id) for blend_id in blend_ids[branch]])
+            else:
+                ids = np.full(len(record), "")
+            columns = {name: record[name] for name in record.dtype.names}
+            segments[branch] = self._write_segment(next_id, columns, ids)
+            next_id += 1
+
+        # Get the dtype for each column
+        columns = {
+            name: {"dtype": column["dtype"], "branches": [b for b in column["branches"] if b in old_branches]}
+            for name, column in self.index["columns"].items()
+        }
+        for branch, record in records.items():
+            for name in record.dtype.names:
+                if name not in columns:
+                    columns[name] = {"dtype": record.dtype[name].str, "branches": []}
+                columns[name]["branches"].append(branch)
+        columns = {name: column for name, column in columns.items() if len(column["branches"]) > 0}
+
+        all_timeouts = {
+            branch: [str(blend_id) for blend_id in timeouts.get(branch, [])]
+            if branch in records else self.get_timeouts(branch)
+            for branch in branches
+        }
+        index = {
+            "branches": branches,
+            "segments": segments,
+            "next_id": next_id,
+            "columns": columns,
+            "timeouts": {branch: ids for branch, ids in all_timeouts.items() if len(ids) > 0},
+            "summaries": summaries,
+        }
+        # Replacing the index is the only step that changes the store,
+        # so the store is never inconsistent (even if a write is interrupted)
+        tmp_filename = self.index_filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_filename, self.index_filename)
+        self.index = index
+        self._columns = {}
+        self._summaries = None
+        self._remove_unused()
+
+    def _write_segment(self, segment_id: int, columns: Dict[str, np.ndarray], blend_ids: np.ndarray) -> str:
+        """Write the records of a branch into a new segment
+
+        :param segment_id: The ID of the segment.
+        :param columns: Dictionary (column name, data) with the measurements in the branch.
+        :param blend_ids: The blend ID of each row in the branch.
+        :return: The name of the segment directory.
+        """
+        segment = "{}{}".format(self.segment_prefix, segment_id)
+        path = os.path.join(self.path, segment)
+        # Remove any remains of an interrupted write
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        np.save(os.path.join(path, self.get_column_filename(self.blend_column)), np.asarray(blend_ids).astype(str))
+        for name, data in columns.items():
+            np.save(os.path.join(path, self.get_column_filename(name)), np.asarray(data))
+        return segment
+
+    def _remove_unused(self) -> None:
+        """Remove the files that are not used by the current index
+
+        This removes the segments of branches that were replaced or removed and old summaries.
+        """
+        segments = set(self.index["segments"].values())
+        summary_file = self.index["summaries"].get("file")
+        for filename in os.listdir(self.path):
+            full_filename = os.path.join(self.path, filename)
+            if filename.startswith(self.segment_prefix) and filename not in segments:
+                shutil.rmtree(full_filename)
+            elif filename.startswith("summaries") and filename.endswith(".npz") and filename != summary_file:
+                os.remove(full_filename)
+
+
+class RecordBuilder:
+    """Assemble the measurement records for a set, one blend at a time
+
+    The records are stored in a preallocated structured array that grows
+    as needed, so the measurements for each blend are copied into place
+    as soon as the blend is finished.
+    Columns are always matched by name, so a deblender that returns its
+    measurements in a different order cannot misalign the columns.
+    If the dtype is not declared it is inferred from the measurements,
+    and each column is upcast (for example from int to float) when a
+    later blend does not fit in the current dtype.
+    """
+    def __init__(self, dtype: np.dtype = None, capacity: int = 1024):
+        """Initialize the class
+
+        :param dtype: The dtype of the records. If `dtype` is `None` then
+            the dtype is inferred from the measurements that are appended,
+            otherwise the measurements are cast into `dtype`.
+        :param capacity: The initial number of rows to allocate.
+        """
+        self.capacity = capacity
+        self.size = 0
+        self._data = None
+        self._blend_ids = []
+        self._infer_dtype = dtype is None
+        if dtype is not None:
+            self._allocate(np.dtype(dtype))
+
+    def _allocate(self, dtype: np.dtype) -> None:
+        """Allocate the array used to store the records
+
+        :param dtype: The dtype of the records.
+        """
+        self._data = np.zeros(self.capacity, dtype=dtype)
+
+    @property
+    def dtype(self) -> np.dtype:
+        """The dtype of the records"""
+        return None if self._data is None else self._data.dtype
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, measurements, blend_id: str = None) -> None:
+        """Add the measurements for a single blend
+
+        :param measurements: Either a structured array or a list of dictionaries
+            with the measurements for each source in the blend.
+        :param blend_id: The ID of the blend.
+        """
+        rows = len(measurements)
+        if rows == 0:
+            return
+        if isinstance(measurements, np.ndarray):
+            names = measurements.dtype.names
+        else:
+            names = tuple(measurements[0].keys())
+        if self._infer_dtype:
+            if isinstance(measurements, np.ndarray):
+                dtype = measurements.dtype
+            else:
+                dtype = np.rec.fromrecords([tuple(m[name] for name in names) for m in measurements],
+                                           names=names).dtype
+            if self._data is None:
+                self._allocate(np.dtype(dtype.descr))
+            elif set(names) == set(self.dtype.names):
+                self._upcast(dtype)
+        if set(names) != set(self.dtype.names):
+            msg = "Measurements with columns {} do not match the records with columns {}"
+            raise ValueError(msg.format(names, self.dtype.names))
+
+        # Grow the array (by doubling) if there isn't enough space
+        if self.size + rows > len(self._data):
+            capacity = max(2 * len(self._data), self.size + rows)
+            data = np.zeros(capacity, dtype=self.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+
+        view = self._data[self.size:self.size + rows]
+        for name in self.dtype.names:
+            if isinstance(measurements, np.ndarray):
+                view[name] = measurements[name]
+            else:
+                view[name] = [m[name] for m in measurements]
+        self._blend_ids += [blend_id] * rows
+        self.size += rows
+
+    def _upcast(self, dtype: np.dtype) -> None:
+        """Promote the dtype of each column so that it can hold the measurements of a blend
+
+        :param dtype: The dtype of the measurements for the blend.
+        """
+        promoted = np.dtype([
+            (name, np.promote_types(self.dtype[name], dtype[name])) for name in self.dtype.names
+        ])
+        if promoted != self.dtype:
+            data = np.zeros(len(self._data), dtype=promoted)
+            for name in self.dtype.names:
+                data[name][:self.size] = self._data[name][:self.size]
+            self._data = data
+
+    @property
+    def blend_ids(self) -> List[str]:
+        """The blend ID for each record"""
+        return self._blend_ids
+
+    @property
+    def records(self) -> np.rec.recarray:
+        """The records that have been appended"""
+        if self._data is None:
+            raise ValueError("No measurements have been added to the records")
+        return self._data[:self.size].view(np.recarray)
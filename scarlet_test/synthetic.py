@@ -0,0 +1,268 @@
+import os
+import time
+from functools import partial
+from typing import Callable, Dict, Sequence
+
+import numpy as np
+
+from . import deblend
+from . import settings
+
+
+# Default grid of the scaling benchmark
+__NUM_SOURCES__ = (1, 10, 50, 100, 500)
+__IMAGE_SIZES__ = (32, 64, 128, 256, 512, 1024)
+# Measurements summarized for each point in the scaling benchmark.
+# "peak RSS (MB)" is the growth of the RSS during each fit (see `instrument.Instrument.memory`),
+# so a grid point does not report the peak of a larger grid point deblended before it
+# in the same process. "peak memory (MB)" is only measured if the deblender traces the memory.
+SCALING_COLUMNS = ("init time", "runtime", "peak memory (MB)", "peak RSS (MB)")
+
+
+def gaussian_psfs(bands: int, shape: int = 43, sigma: float = 1.5, rng: np.random.Generator = None) -> np.ndarray:
+    """Create a normalized, circular Gaussian PSF in each band
+
+    :param bands: The number of bands.
+    :param shape: The width (and height) of each PSF image.
+    :param sigma: The median width of the PSFs, in pixels.
+        The width in each band is scattered around `sigma` by 10%.
+    :param rng: The random number generator.
+    :return: The PSF images, with shape `(bands, shape, shape)`.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    sigmas = sigma * (1 + 0.1 * rng.uniform(-1, 1, bands))
+    y, x = np.indices((shape, shape)) - shape // 2
+    psfs = np.exp(-(x**2 + y**2)[None] / (2 * sigmas[:, None, None]**2))
+    return (psfs / np.sum(psfs, axis=(1, 2), keepdims=True)).astype(np.float32)
+
+
+def check_blend_size(num_sources: int, size: int, edge: int = 3) -> None:
+    """Check that the sources of a synthetic blend fit in its images
+
+    :param num_sources: The number of sources in the blend.
+    :param size: The width (and height) of the images, in pixels.
+    :param edge: The minimum distance (in pixels) from the center of
+        each source to the edge of the images.
+    """
+    width = size - 2 * edge
+    if width <= 0 or num_sources > width**2:
+        msg = "Cannot fit {} sources in a {}x{} image with an edge of {} pixels"
+        raise ValueError(msg.format(num_sources, size, size, edge))
+
+
+def make_blend(
+        num_sources: int,
+        size: int,
+        filters: str = None,
+        rng: np.random.Generator = None,
+        noise: float = 0.04,
+        psf_sigma: float = 1.5,
+        edge: int = 3,
+) -> Dict[str, np.ndarray]:
+    """Create a synthetic blend with the same schema as the test sets
+
+    Each source is an elliptical Gaussian galaxy (convolved with the
+    Gaussian PSF of each band) with a random flux, color and shape,
+    and the images are given Gaussian noise with a constant variance.
+    The true magnitude of each source is stored in `matched` as
+    "<band>magVar" using the same zero point as `measure.measure_blend`.
+
+    :param num_sources: The number of sources in the blend.
+    :param size: The width (and height) of the images, in pixels.
+    :param filters: The filter name for each band. If `filters`
+        is `None` then `settings.filters` is used.
+    :param rng: The random number generator.
+    :param noise: The standard deviation of the noise in each pixel.
+    :param psf_sigma: The median width of the PSF, in pixels.
+    :param edge: The minimum distance (in pixels) from the center of
+        each source to the edge of the images.
+    :return: Dictionary with the `images`, `variance`, `footprint`, `psfs`,
+        `centers` and `matched` arrays used by `deblend.deblend`.
+    """
+    if filters is None:
+        filters = settings.filters
+    if rng is None:
+        rng = np.random.default_rng()
+    bands = len(filters)
+    check_blend_size(num_sources, size, edge)
+    width = size - 2 * edge
+
+    # Place the sources at unique pixels
+    pixels = rng.choice(width**2, size=num_sources, replace=False)
+    centers = np.stack([pixels // width + edge, pixels % width + edge], axis=1).astype(np.int64)
+
+    # Draw the flux (in each band) and shape of each source
+    flux = 10**rng.uniform(1.5, 3.5, num_sources)
+    sed = rng.uniform(0.5, 1.5, (num_sources, bands))
+    sed /= np.sum(sed, axis=1, keepdims=True)
+    fluxes = flux[:, None] * sed
+    sigma_major = rng.uniform(1, 4, num_sources)
+    sigma_minor = sigma_major * rng.uniform(0.4, 1, num_sources)
+    angle = rng.uniform(0, np.pi, num_sources)
+    psfs = gaussian_psfs(bands, sigma=psf_sigma, rng=rng)
+    # The width of the PSF in each band, measured from its second moment
+    y, x = np.indices(psfs.shape[1:]) - psfs.shape[1] // 2
+    psf_var = np.sum(psfs * x[None]**2, axis=(1, 2))
+
+    # Render each source on a stamp around its center, so the cost
+    # scales with the number of sources and not the number of pixels
+    images = np.zeros((bands, size, size), dtype=np.float64)
+    for k in range(num_sources):
+        cy, cx = centers[k]
+        radius = int(np.ceil(5 * np.sqrt(sigma_major[k]**2 + np.max(psf_var))))
+        y0, y1 = max(cy - radius, 0), min(cy + radius + 1, size)
+        x0, x1 = max(cx - radius, 0), min(cx + radius + 1, size)
+        dy, dx = np.mgrid[y0-cy:y1-cy, x0-cx:x1-cx]
+        cos, sin = np.cos(angle[k]), np.sin(angle[k])
+        u = cos * dx + sin * dy
+        v = -sin * dx + cos * dy
+        # The convolution of two Gaussians is a Gaussian with the sum of their variances
+        var_u = sigma_major[k]**2 + psf_var[:, None, None]
+        var_v = sigma_minor[k]**2 + psf_var[:, None, None]
+        profile = np.exp(-u[None]**2 / (2 * var_u) - v[None]**2 / (2 * var_v)) / (2 * np.pi * np.sqrt(var_u * var_v))
+        images[:, y0:y1, x0:x1] += fluxes[k][:, None, None] * profile
+    images += rng.normal(0, noise, images.shape)
+
+    matched = np.zeros(num_sources, dtype=[("x", "<f8"), ("y", "<f8")] + [
+        ("{}magVar".format(f), "<f8") for f in filters])
+    matched["y"] = centers[:, 0]
+    matched["x"] = centers[:, 1]
+    for b, f in enumerate(filters):
+        matched["{}magVar".format(f)] = 27 - 2.5 * np.log10(fluxes[:, b])
+
+    return {
+        "images": images.astype(np.float32),
+        "variance": np.full(images.shape, noise**2, dtype=np.float32),
+        "footprint": np.zeros((size, size), dtype=bool),
+        "psfs": psfs,
+        "centers": centers,
+        "matched": matched,
+    }
+
+
+def write_blends(
+        path: str,
+        num_blends: int,
+        num_sources: int,
+        size: int,
+        filters: str = None,
+        seed: int = None,
+) -> Sequence[str]:
+    """Write a set of synthetic blends
+
+    The blends are saved as "<blend ID>.npz" in `path`, so the
+    set can be deblended with `deblend_and_measure(data_path=path)`.
+
+    :param path: The directory to save the blends.
+        It should not contain any other files.
+    :param num_blends: The number of blends in the set.
+    :param num_sources: The number of sources in each blend.
+    :param size: The width (and height) of each blend, in pixels.
+    :param filters: The filter name for each band (see `make_blend`).
+    :param seed: The seed of the random number generator.
+    :return: The IDs of the blends.
+    """
+    # Check the size first, so that an empty directory is not left behind
+    check_blend_size(num_sources, size)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    rng = np.random.default_rng(seed)
+    blend_ids = []
+    for k in range(num_blends):
+        blend_id = "synthetic_{}".format(k)
+        np.savez(os.path.join(path, "{}.npz".format(blend_id)), **make_blend(num_sources, size, filters, rng))
+        blend_ids.append(blend_id)
+    return blend_ids
+
+
+def run_scaling(
+        path: str,
+        num_sources: Sequence[int] = __NUM_SOURCES__,
+        sizes: Sequence[int] = __IMAGE_SIZES__,
+        num_blends: int = 4,
+        deblender: Callable = None,
+        workers: int = None,
+        seed: int = 0,
+        filename: str = None,
+) -> np.rec.recarray:
+    """Measure how the deblender scales with the number of sources and image size
+
+    A set of synthetic blends is written for each point in the grid (unless
+    all of its blends already exist in `path`) and deblended with `deblend_and_measure`.
+    The directory of each set includes `num_blends` and `seed`, so changing
+    them creates a new set instead of reusing an old one.
+    Grid points with more sources than can fit in the image are skipped.
+    The measurements are not saved to the measurement store, so the
+    scaling benchmark does not interfere with the regression tests.
+
+    :param path: The directory used to save the synthetic blends.
+    :param num_sources: The number of sources in each blend.
+    :param sizes: The width (and height) of each blend, in pixels.
+    :param num_blends: The number of blends at each grid point.
+    :param deblender: The function used to deblend
+        (see `deblend_and_measure`).
+    :param workers: Number of processes used to deblend each set.
+    :param seed: The seed used to generate the blends.
+    :param filename: The npz file to save the results.
+        If `filename` is `None` then the results are not saved.
+    :return: Records with a row for each grid point, containing the number of
+        `sources`, the image `size`, the wall clock time to deblend the set
+        (`wall time`), and the median of each of the `SCALING_COLUMNS`.
+    """
+    from .core import deblend_and_measure
+
+    if deblender is None:
+        deblender = partial(deblend.deblend, max_iter=settings.max_iter, e_rel=settings.e_rel)
+    rows = []
+    for n in num_sources:
+        for size in sizes:
+            data_path = os.path.join(path, "n{}_size{}_blends{}_seed{}".format(n, size, num_blends, seed))
+            existing = os.listdir(data_path) if os.path.exists(data_path) else []
+            # A set that was only partly written is written again
+            if len([f for f in existing if f.endswith(".npz")]) != num_blends:
+                try:
+                    write_blends(data_path, num_blends, n, size, seed=seed)
+                except ValueError:
+                    continue
+            print("deblending {} sources in a {}x{} image".format(n, size, size))
+            t0 = time.time()
+            records = deblend_and_measure(data_path=data_path, deblender=deblender, workers=workers)
+            wall_time = time.time() - t0
+            rows.append((n, size, wall_time) + tuple(
+                np.median(records[name]) if name in records.dtype.names else np.nan
+                for name in SCALING_COLUMNS
+            ))
+    results = np.rec.fromrecords(rows, names=("sources", "size", "wall time") + SCALING_COLUMNS)
+    if filename is not None:
+        np.savez(filename, results=results)
+    return results
+
+
+def plot_scaling(results: np.rec.recarray, name: str = "runtime", filename: str = None):
+    """Plot a scaling curve for each image size
+
+    :param results: The output of `run_scaling`.
+    :param name: The name of the column to plot.
+    :param filename: The name of the file to save the plot.
+        If `filename` is `None` then the plot is shown.
+    :return: The figure.
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for size in np.unique(results["size"]):
+        rows = results[results["size"] == size]
+        order = np.argsort(rows["sources"])
+        ax.plot(rows["sources"][order], rows[name][order], ".-", label="{0}x{0}".format(size))
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    ax.set_xlabel("sources")
+    ax.set_ylabel(name)
+    ax.legend(title="image size")
+    if filename is not None:
+        fig.savefig(filename)
+        plt.close(fig)
+    else:
+        plt.show()
+    return fig
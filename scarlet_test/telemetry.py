@@ -0,0 +1,347 @@
+import json
+import math
+import os
+import socket
+import time
+from typing import Dict, List, Sequence, TextIO
+
+import numpy as np
+
+
+# Latency quantiles reported in the console summary
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+# Measurements (besides the "<stage> time" spans) included in the stage timings of each blend
+MEMORY_COLUMNS = ("peak memory (MB)",)
+
+
+def open_stream(target: str) -> TextIO:
+    """Open the destination of an event stream
+
+    :param target: Either the name of a file, which the events are
+        appended to, or "tcp://<host>:<port>" to send the events to a socket.
+    :return: A text stream to write the events.
+    """
+    if target.startswith("tcp://"):
+        host, port = target[len("tcp://"):].rsplit(":", 1)
+        connection = socket.create_connection((host, int(port)))
+        return connection.makefile("w", encoding="utf-8")
+    path = os.path.dirname(target)
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+    return open(target, "a", encoding="utf-8")
+
+
+def _to_json(value):
+    """Convert a value into something that can be written as (strict) JSON
+
+    numpy types are converted into python types, and
+    `NaN` or infinite values are written as `null`.
+    """
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+class EventStream:
+    """A stream of JSON lines describing the progress of a run
+
+    Every event is a single line with the name of the `event`, the unix `time`
+    and the `pid` of the process that emitted it, followed by the fields of the
+    event. Each line is written (and flushed) with a single call, so the
+    worker processes can append to the same file as the main process.
+    Telemetry should never stop a run, so if the stream cannot be written
+    (for example the socket was closed) a warning is printed and the
+    remaining events are dropped.
+    """
+    def __init__(self, target: str = None, stream: TextIO = None):
+        """Initialize the class
+
+        :param target: The destination of the events (see `open_stream`).
+        :param stream: An open text stream used instead of `target`.
+            If both are `None` then the events are not written anywhere.
+        """
+        self.target = target
+        if stream is None and target is not None:
+            stream = open_stream(target)
+        self.stream = stream
+
+    def emit(self, event: str, **fields) -> Dict:
+        """Write a single event
+
+        :param event: The name of the event.
+        :param fields: The fields of the event.
+        :return: The event.
+        """
+        record = {"event": event, "time": time.time(), "pid": os.getpid()}
+        record.update(fields)
+        if self.stream is not None:
+            try:
+                self.stream.write(json.dumps(_to_json(record), allow_nan=False) + "\n")
+                self.stream.flush()
+            except OSError as e:
+                print("telemetry disabled, could not write to {}: {}".format(self.target, e))
+                self.stream = None
+        return record
+
+    def close(self) -> None:
+        """Close the stream"""
+        if self.stream is not None and self.target is not None:
+            self.stream.close()
+        self.stream = None
+
+
+_streams = {}
+
+
+def get_event_stream(target: str = None) -> EventStream:
+    """Get the event stream for a target
+
+    Each target is only opened once per process, so that the workers
+    do not reopen the stream (or share a socket with their parent) for every blend.
+
+    :param target: The destination of the events (see `open_stream`).
+        If `target` is `None` then the events are not written.
+    :return: The event stream.
+    """
+    key = (os.getpid(), target)
+    if key not in _streams:
+        _streams[key] = EventStream(target)
+    return _streams[key]
+
+
+def get_blend_stats(measurements, wall_time: float, cpu_time: float) -> Dict:
+    """Summarize the cost of deblending a single blend
+
+    :param measurements: Either a structured array or a list of dictionaries
+        with the measurements for each source in the blend.
+    :param wall_time: The wall clock time to deblend the blend, in seconds.
+    :param cpu_time: The CPU time used by the process to deblend the blend, in seconds.
+    :return: Dictionary with the `wall time`, `cpu time`, the number of `sources`,
+        the `sources per second`, the `peak RSS (MB)` of the blend (the growth of
+        the RSS while it was fit, see `instrument.Instrument.memory`) and the
+        `stages` timings (every "<stage> time" measurement, in ms) of the blend.
+    """
+    sources = len(measurements)
+    stages = {}
+    rss = np.nan
+    if sources > 0:
+        first = measurements[0]
+        names = first.dtype.names if isinstance(measurements, np.ndarray) else first.keys()
+        # The stage timings are the same for every source in the blend
+        stages = {
+            name: float(first[name]) for name in names
+            if name.endswith(" time") or name == "runtime" or name in MEMORY_COLUMNS
+        }
+        # Warm started runs prefix the name (see `measure.get_warm_start_name`)
+        rss_names = [name for name in names if name.endswith("peak RSS (MB)")]
+        if len(rss_names) > 0:
+            rss = float(first[rss_names[0]])
+    return {
+        "wall time": wall_time,
+        "cpu time": cpu_time,
+        "sources": sources,
+        "sources per second": sources / wall_time if wall_time > 0 else np.nan,
+        "peak RSS (MB)": rss,
+        "stages": stages,
+    }
+
+
+def format_duration(seconds: float) -> str:
+    """Format a duration as hours, minutes and seconds
+
+    :param seconds: The duration.
+    :return: The formatted duration.
+    """
+    if not np.isfinite(seconds):
+        return "?"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds)
+    if minutes > 0:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
+class ProgressMonitor:
+    """Track the progress of a run from the results of each blend
+
+    A line with the latency of the blend, the throughput of the run, the ETA
+    and the number of failures so far is printed as each blend is finished,
+    and a "progress" event with the same information is emitted.
+    The per-blend "blend started" and "blend finished" events are emitted
+    where the blend is deblended (see `core.run_deblender`), so they
+    are visible as soon as a worker finishes a blend.
+    """
+    def __init__(
+            self,
+            blend_ids: Sequence[str],
+            events: EventStream = None,
+            cached: int = 0,
+            verbose: bool = True,
+            **fields
+    ):
+        """Initialize the class
+
+        :param blend_ids: The IDs of the blends in the run.
+        :param events: The stream used to emit the events.
+            If `events` is `None` then no events are emitted.
+        :param cached: The number of blends loaded from the cache
+            (which are not deblended, so they do not count towards the throughput).
+        :param verbose: Whether or not to print the progress of each blend.
+        :param fields: Additional fields (for example the `set_id` and `branch`)
+            included in the "run started" and "run finished" events.
+        """
+        if events is None:
+            events = EventStream()
+        self.events = events
+        self.num_blends = len(blend_ids)
+        self.cached = cached
+        self.verbose = verbose
+        self.fields = fields
+        self.latencies = []
+        self.sources = 0
+        self.timeouts = []
+        self.errors = []
+        self.start = time.perf_counter()
+        self.events.emit("run started", blends=self.num_blends, cached=cached, **fields)
+
+    @property
+    def finished(self) -> int:
+        """The number of blends deblended so far (including blends that failed)"""
+        return len(self.latencies) + len(self.timeouts) + len(self.errors)
+
+    @property
+    def remaining(self) -> int:
+        """The number of blends that still have to be deblended"""
+        return self.num_blends - self.cached - self.finished
+
+    def get_progress(self) -> Dict:
+        """The throughput and ETA of the run so far
+
+        :return: Dictionary with the number of `finished`, `cached`, `timed out`
+            and `failed` blends, the `elapsed` wall time, the `blends per second`
+            and `sources per second` and the `eta` (in seconds).
+        """
+        elapsed = time.perf_counter() - self.start
+        rate = self.finished / elapsed if elapsed > 0 else np.nan
+        return {
+            "finished": self.finished,
+            "blends": self.num_blends,
+            "cached": self.cached,
+            "timed out": len(self.timeouts),
+            "failed": len(self.errors),
+            "elapsed": elapsed,
+            "blends per second": rate,
+            "sources per second": self.sources / elapsed if elapsed > 0 else np.nan,
+            "eta": self.remaining / rate if rate > 0 else np.nan,
+        }
+
+    def update(self, blend_id: str, stats: Dict) -> Dict:
+        """Record the result of a blend
+
+        :param blend_id: The ID of the blend.
+        :param stats: The statistics of the blend (see `core.run_deblender`).
+        :return: The progress of the run (see `get_progress`).
+        """
+        if stats["status"] == "timeout":
+            self.timeouts.append(str(blend_id))
+        else:
+            self.latencies.append(stats["wall time"])
+            self.sources += stats["sources"]
+        return self._report(blend_id, stats)
+
+    def fail(self, blend_id: str, error: str) -> Dict:
+        """Record a blend that raised an error
+
+        :param blend_id: The ID of the blend.
+        :param error: The error message.
+        :return: The progress of the run (see `get_progress`).
+        """
+        self.errors.append(str(blend_id))
+        return self._report(blend_id, {"status": "error", "error": error})
+
+    def _report(self, blend_id: str, stats: Dict) -> Dict:
+        """Emit and print the progress after a blend is finished"""
+        progress = self.get_progress()
+        self.events.emit("progress", blend_id=str(blend_id), status=stats["status"], **progress)
+        if self.verbose:
+            if stats["status"] == "ok":
+                result = "{:.2f}s, {} sources".format(stats["wall time"], stats["sources"])
+            else:
+                result = stats["status"]
+            msg = "blend {} of {}: {} ({}) | {:.2f} blends/s, {:.1f} sources/s | ETA {}"
+            msg = msg.format(
+                self.cached + progress["finished"], self.num_blends, blend_id, result,
+                progress["blends per second"], progress["sources per second"], format_duration(progress["eta"]))
+            if len(self.timeouts) + len(self.errors) > 0:
+                msg += " | {} timed out, {} failed".format(len(self.timeouts), len(self.errors))
+            print(msg)
+        return progress
+
+    def get_summary(self) -> Dict:
+        """Summarize the run
+
+        :return: The progress of the run (see `get_progress`), with the
+            `latency <quantile>` and `latency max` of the blends (in seconds)
+            and the IDs of the `timed out blends` and `failed blends`.
+        """
+        summary = self.get_progress()
+        latencies = np.array(self.latencies)
+        for q in LATENCY_QUANTILES:
+            key = "latency p{:g}".format(100 * q)
+            summary[key] = np.quantile(latencies, q) if len(latencies) > 0 else np.nan
+        summary["latency max"] = np.max(latencies) if len(latencies) > 0 else np.nan
+        summary["timed out blends"] = self.timeouts
+        summary["failed blends"] = self.errors
+        return summary
+
+    def close(self, status: str = "ok") -> Dict:
+        """Emit the "run finished" event and print the summary of the run
+
+        :param status: The status of the run, either "ok" or "error"
+            if the run was stopped by an error.
+        :return: The summary of the run (see `get_summary`).
+        """
+        summary = self.get_summary()
+        self.events.emit("run finished", status=status, **dict(self.fields, **summary))
+        if self.verbose:
+            print(format_summary(summary))
+        return summary
+
+
+def format_summary(summary: Dict) -> str:
+    """Format the summary of a run
+
+    :param summary: The summary of the run (see `ProgressMonitor.get_summary`).
+    :return: The formatted summary.
+    """
+    latencies = ", ".join(
+        "{} {}".format(key[len("latency "):], "{:.3g}s".format(summary[key]) if np.isfinite(summary[key]) else "-")
+        for key in summary if key.startswith("latency ")
+    )
+    lines = [
+        "deblended {} of {} blends ({} cached) in {}".format(
+            summary["finished"], summary["blends"], summary["cached"], format_duration(summary["elapsed"])),
+        "throughput: {:.2f} blends/s, {:.1f} sources/s".format(
+            summary["blends per second"], summary["sources per second"]),
+        "latency: {}".format(latencies),
+        "failures: {} timed out, {} failed".format(summary["timed out"], summary["failed"]),
+    ]
+    return "\n".join(lines)
+
+
+def read_events(filename: str) -> List[Dict]:
+    """Load the events written to a file
+
+    :param filename: The name of the file.
+    :return: The events, in the order they were written.
+    """
+    with open(filename, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -16,5 +16,5 @@ setuptools.setup(
     author="Fred Moolekamp, Peter Melchior, and Remy Joseph",
     author_email="peter.m.melchior@gmail.com",
     url="https://github.com/fred3m/scarlet_test",
-    scripts=["bin/scarlet_test"]
+    scripts=["bin/scarlet_test", "bin/scarlet_scaling"]
 )